@@ -0,0 +1,44 @@
+from typing import Collection, List, Optional
+
+from app.globals import DEFAULT_ENDPOINT_LATENCY
+from app.analysis.health import get_health, CLOSED
+
+
+def _expected_wait(url: str, default_latency: float) -> float:
+    """Latency-weighted number of requests in progress of an endpoint."""
+    health = get_health(url)
+    latency = health.latency(0.5)
+    if latency is None:
+        latency = default_latency
+    return (health.outstanding + 1) * latency
+
+
+def choose_endpoint(
+        urls: List[str], exclude: Collection[str] = ()
+) -> Optional[str]:
+    """Endpoint of a service the next request should go to.
+
+    Among the healthy endpoints, the one with the fewest requests in
+    progress weighted by its median latency is chosen. If none is
+    healthy, an endpoint whose circuit accepts a trial request is
+    chosen. Returns None if no endpoint can take the request.
+    """
+    candidates = [url for url in urls if url not in exclude]
+    healthy = [url for url in candidates if get_health(url).state == CLOSED]
+    if healthy:
+        latencies = [
+            latency for latency in (
+                get_health(url).latency(0.5) for url in healthy
+            ) if latency is not None
+        ]
+        default_latency = (
+            sum(latencies) / len(latencies) if latencies
+            else DEFAULT_ENDPOINT_LATENCY
+        )
+        return min(
+            healthy, key=lambda url: _expected_wait(url, default_latency)
+        )
+    for url in candidates:
+        if get_health(url).accepts_trial():
+            return url
+    return None
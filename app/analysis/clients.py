@@ -0,0 +1,47 @@
+from typing import Dict
+
+import httpx
+from httpx import AsyncClient
+
+from app.globals import (
+    SERVICE_MAX_CONNECTIONS, SERVICE_MAX_KEEPALIVE_CONNECTIONS,
+    SERVICE_KEEPALIVE_EXPIRY, SERVICE_CONNECT_TIMEOUT, SERVICE_READ_TIMEOUT,
+    SERVICE_HTTP2
+)
+
+
+# One client (with its own connection pool) per analysis service, kept
+# for the lifetime of the application so connections are reused
+_clients: Dict[int, AsyncClient] = {}
+
+
+def _create_client() -> AsyncClient:
+    return AsyncClient(
+        limits=httpx.Limits(
+            max_connections=SERVICE_MAX_CONNECTIONS,
+            max_keepalive_connections=SERVICE_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=SERVICE_KEEPALIVE_EXPIRY,
+        ),
+        timeout=httpx.Timeout(
+            SERVICE_READ_TIMEOUT, connect=SERVICE_CONNECT_TIMEOUT
+        ),
+        http2=SERVICE_HTTP2,
+    )
+
+
+def get_client(service_id: int) -> AsyncClient:
+    client = _clients.get(service_id)
+    if client is None:
+        client = _clients[service_id] = _create_client()
+    return client
+
+
+async def close_client(service_id: int) -> None:
+    client = _clients.pop(service_id, None)
+    if client is not None:
+        await client.aclose()
+
+
+async def close_clients() -> None:
+    for service_id in list(_clients):
+        await close_client(service_id)
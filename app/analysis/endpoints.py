@@ -0,0 +1,18 @@
+from typing import Dict, List, Mapping
+
+from app.data.catalog import get_service_replicas
+
+
+def get_endpoints(db_services: List[Mapping]) -> Dict[int, List[Dict]]:
+    """URL and health URL of the endpoints of each service, by service id:
+    the URL of the service first, then its replicas.
+    """
+    return {
+        db_service['id']: [
+            dict(url=db_service['url'], health_url=db_service['health_url'])
+        ] + [
+            dict(url=endpoint['url'], health_url=endpoint['health_url'])
+            for endpoint in get_service_replicas(db_service['id'])
+        ]
+        for db_service in db_services
+    }
@@ -0,0 +1,191 @@
+import asyncio
+import time
+from collections import deque
+from typing import Dict, List, Mapping, Optional
+
+import httpx
+
+from app.globals import (
+    HEALTH_PROBE_INTERVAL, HEALTH_PROBE_TIMEOUT, HEALTH_WINDOW,
+    CIRCUIT_FAILURES, CIRCUIT_MIN_REQUESTS, CIRCUIT_ERROR_RATE,
+    CIRCUIT_COOLDOWN
+)
+from app.analysis.clients import get_client
+from app.analysis.endpoints import get_endpoints
+from app.data.catalog import get_services
+
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class EndpointHealth:
+    """Recent requests to a service endpoint and its circuit breaker.
+
+    Latencies and error rates come from the analysis requests; health
+    probes only move the circuit breaker.
+    """
+
+    def __init__(self):
+        # (succeeded, seconds) of the latest requests
+        self._window = deque(maxlen=HEALTH_WINDOW)
+        self._consecutive_failures = 0
+        self._opened_at: Optional[float] = None
+        self._trial_in_progress = False
+        self.last_probe: Optional[float] = None
+        # Requests in progress
+        self.outstanding = 0
+
+    @property
+    def state(self) -> str:
+        if self._opened_at is None:
+            return CLOSED
+        if time.monotonic() - self._opened_at < CIRCUIT_COOLDOWN:
+            return OPEN
+        return HALF_OPEN
+
+    @property
+    def error_rate(self) -> Optional[float]:
+        if not self._window:
+            return None
+        failures = sum(1 for succeeded, _ in self._window if not succeeded)
+        return failures / len(self._window)
+
+    def latency(self, percentile: float) -> Optional[float]:
+        """Latency percentile of the successful requests, in seconds."""
+        latencies = sorted(
+            seconds for succeeded, seconds in self._window if succeeded
+        )
+        if not latencies:
+            return None
+        index = min(int(percentile * len(latencies)), len(latencies) - 1)
+        return latencies[index]
+
+    def accepts_trial(self) -> bool:
+        """Whether the circuit is half-open and free for a trial request."""
+        return self.state == HALF_OPEN and not self._trial_in_progress
+
+    def allow_request(self) -> bool:
+        state = self.state
+        if state == CLOSED:
+            return True
+        if state == HALF_OPEN and not self._trial_in_progress:
+            # Let a single trial request through, until it is released
+            self._trial_in_progress = True
+            return True
+        return False
+
+    def release_trial(self) -> None:
+        self._trial_in_progress = False
+
+    def record(self, succeeded: bool,
+               seconds: Optional[float] = None) -> None:
+        if seconds is not None:
+            self._window.append((succeeded, seconds))
+        if succeeded:
+            self._consecutive_failures = 0
+            if self.state != OPEN:
+                self._opened_at = None
+            return
+        self._consecutive_failures += 1
+        error_rate = self.error_rate
+        if (self.state == HALF_OPEN
+                or self._consecutive_failures >= CIRCUIT_FAILURES
+                or (len(self._window) >= CIRCUIT_MIN_REQUESTS
+                    and error_rate >= CIRCUIT_ERROR_RATE)):
+            self._opened_at = time.monotonic()
+
+    def as_dict(self) -> Dict:
+        return {
+            'state': self.state,
+            'requests': len(self._window),
+            'outstanding': self.outstanding,
+            'last_probe': self.last_probe,
+            'error_rate': self.error_rate,
+            'latency_p50': self.latency(0.5),
+            'latency_p95': self.latency(0.95),
+        }
+
+
+# Health of every service endpoint known by this process, by URL
+_health: Dict[str, EndpointHealth] = {}
+_prober: Optional[asyncio.Task] = None
+
+
+def get_health(url: str) -> EndpointHealth:
+    health = _health.get(url)
+    if health is None:
+        health = _health[url] = EndpointHealth()
+    return health
+
+
+async def _probe(service_id: int, endpoint: Mapping) -> None:
+    """Check that a service endpoint answers.
+
+    Any answer but a server error counts as healthy: analysis endpoints
+    usually only accept POST requests.
+    """
+    url = endpoint['health_url'] or endpoint['url']
+    health = get_health(endpoint['url'])
+    try:
+        response = await get_client(service_id).get(
+            url, timeout=HEALTH_PROBE_TIMEOUT
+        )
+        succeeded = response.status_code < 500
+    except httpx.HTTPError:
+        succeeded = False
+    health.record(succeeded)
+    health.last_probe = time.time()
+
+
+async def _probe_all() -> None:
+    while True:
+        try:
+            endpoints = get_endpoints(get_services())
+            await asyncio.gather(*(
+                _probe(service_id, endpoint)
+                for service_id, service_endpoints in endpoints.items()
+                for endpoint in service_endpoints
+            ))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print('Health prober error: {!r}'.format(e))
+        await asyncio.sleep(HEALTH_PROBE_INTERVAL)
+
+
+def start_prober() -> None:
+    global _prober
+    _prober = asyncio.ensure_future(_probe_all())
+
+
+async def stop_prober() -> None:
+    global _prober
+    if _prober is not None:
+        _prober.cancel()
+        await asyncio.gather(_prober, return_exceptions=True)
+        _prober = None
+
+
+def services_health(db_services: List[Mapping]) -> List[Dict]:
+    endpoints = get_endpoints(db_services)
+    result = []
+    for db_service in db_services:
+        endpoints_health = [
+            dict(url=endpoint['url'], **get_health(endpoint['url']).as_dict())
+            for endpoint in endpoints[db_service['id']]
+        ]
+        states = {
+            endpoint_health['state'] for endpoint_health in endpoints_health
+        }
+        state = next(
+            state for state in (CLOSED, HALF_OPEN, OPEN) if state in states
+        )
+        result.append(dict(
+            service_id=db_service['id'],
+            name=db_service['name'],
+            state=state,
+            endpoints=endpoints_health,
+        ))
+    return result
@@ -0,0 +1,202 @@
+import asyncio
+import datetime
+from typing import List, Mapping, Optional
+
+from fastapi import HTTPException
+from sqlalchemy.sql import select, func, and_
+
+from app.globals import (
+    JOB_WORKERS, JOB_POLL_INTERVAL, JOB_MAX_ATTEMPTS, JOB_RETRY_BACKOFF,
+    JOB_RETRY_MAX_BACKOFF, JOB_LEASE, JOB_HEARTBEAT_INTERVAL
+)
+from app.analysis.runner import analyse_image
+from app.data.catalog import find_service
+from app.data.database import database, jobs
+
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+# Claim the oldest runnable job, skipping the ones other workers (of
+# this or any other process) are claiming. Running jobs whose lease
+# expired belong to a dead worker and are claimed again.
+CLAIM_JOB_QUERY = """
+    UPDATE jobs
+    SET status = 'running',
+        attempts = attempts + 1,
+        locked_until = now() + make_interval(secs => :lease),
+        updated_at = now()
+    WHERE id = (
+        SELECT id FROM jobs
+        WHERE (status = 'queued' AND run_after <= now())
+            OR (status = 'running' AND locked_until < now())
+        ORDER BY run_after, id
+        LIMIT 1
+        FOR UPDATE SKIP LOCKED
+    )
+    RETURNING id, service_id, image_id, attempts, max_attempts, force
+"""
+
+_workers: List[asyncio.Task] = []
+# Set when a job is submitted, to wake up the idle workers. Created when
+# the workers start, in the loop of the application
+_submitted: Optional[asyncio.Event] = None
+
+
+async def submit_job(
+        service_id: int, image_id: int, user_id: int,
+        result_id: Optional[int] = None, force: bool = False
+) -> int:
+    """Queue the analysis of an image, returning the id of the job.
+
+    If `result_id` is given the result is already available and the job
+    is created as done. With `force`, the analysis is run even if another
+    process has just run it.
+    """
+    query = jobs.insert().values(
+        service_id=service_id,
+        image_id=image_id,
+        user_id=user_id,
+        status=QUEUED if result_id is None else DONE,
+        attempts=0,
+        max_attempts=JOB_MAX_ATTEMPTS,
+        run_after=func.now(),
+        result_id=result_id,
+        force=force,
+        created_at=func.now(),
+        updated_at=func.now(),
+    )
+    job_id = await database.execute(query)
+    if _submitted is not None:
+        _submitted.set()
+    return job_id
+
+
+async def get_job(job_id: int) -> Optional[Mapping]:
+    query = select([jobs]).where(jobs.c.id == job_id)
+    return await database.fetch_one(query)
+
+
+async def _finish_job(
+        job_id: int, status: str, result_id: Optional[int] = None,
+        error: Optional[str] = None
+) -> None:
+    query = jobs.update().values(
+        status=status,
+        result_id=result_id,
+        error=error,
+        locked_until=None,
+        updated_at=func.now(),
+    ).where(jobs.c.id == job_id)
+    await database.execute(query)
+
+
+async def _retry_job(job: Mapping, error: str) -> None:
+    if job['attempts'] >= job['max_attempts']:
+        await _finish_job(job['id'], FAILED, error=error)
+        return
+    backoff = min(
+        JOB_RETRY_BACKOFF * 2 ** (job['attempts'] - 1), JOB_RETRY_MAX_BACKOFF
+    )
+    query = jobs.update().values(
+        status=QUEUED,
+        error=error,
+        run_after=func.now() + datetime.timedelta(seconds=backoff),
+        locked_until=None,
+        updated_at=func.now(),
+    ).where(jobs.c.id == job['id'])
+    await database.execute(query)
+
+
+async def _requeue_job(job_id: int) -> None:
+    # The attempt is given back: the job was stopped, it did not fail
+    query = jobs.update().values(
+        status=QUEUED,
+        attempts=jobs.c.attempts - 1,
+        locked_until=None,
+        updated_at=func.now(),
+    ).where(and_(jobs.c.id == job_id, jobs.c.status == RUNNING))
+    await database.execute(query)
+
+
+async def _heartbeat(job_id: int) -> None:
+    """Renew the lease of a running job until cancelled."""
+    while True:
+        await asyncio.sleep(JOB_HEARTBEAT_INTERVAL)
+        query = jobs.update().values(
+            locked_until=func.now() + datetime.timedelta(seconds=JOB_LEASE),
+        ).where(and_(jobs.c.id == job_id, jobs.c.status == RUNNING))
+        try:
+            await database.execute(query)
+        except Exception as e:
+            print('Analysis job heartbeat error: {!r}'.format(e))
+
+
+async def _run_job(job: Mapping) -> None:
+    if job['attempts'] > job['max_attempts']:
+        # Its worker died on the last attempt
+        await _finish_job(job['id'], FAILED, error='Too many attempts')
+        return
+    db_service = find_service(job['service_id'])
+    if db_service is None:
+        await _finish_job(job['id'], FAILED, error='Service not found')
+        return
+    heartbeat = asyncio.ensure_future(_heartbeat(job['id']))
+    try:
+        try:
+            result_id, _ = await analyse_image(
+                db_service, job['image_id'], job['force']
+            )
+        except HTTPException as e:
+            # Client errors (e.g. an invalid result) will not go away
+            if e.status_code < 500:
+                await _finish_job(job['id'], FAILED, error=str(e.detail))
+            else:
+                await _retry_job(job, str(e.detail))
+        except Exception as e:
+            await _retry_job(job, repr(e))
+        else:
+            await _finish_job(job['id'], DONE, result_id=result_id)
+    except asyncio.CancelledError:
+        # The workers are stopping: let any other one run it right away
+        await _requeue_job(job['id'])
+        raise
+    finally:
+        heartbeat.cancel()
+
+
+async def _worker() -> None:
+    while True:
+        try:
+            job = await database.fetch_one(
+                query=CLAIM_JOB_QUERY, values={'lease': JOB_LEASE}
+            )
+            if job is not None:
+                await _run_job(job)
+                continue
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print('Analysis job worker error: {!r}'.format(e))
+        # Nothing to do: wait for a new job or poll again later
+        _submitted.clear()
+        try:
+            await asyncio.wait_for(_submitted.wait(), JOB_POLL_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+
+
+def start_workers() -> None:
+    global _submitted
+    _submitted = asyncio.Event()
+    for _ in range(JOB_WORKERS):
+        _workers.append(asyncio.ensure_future(_worker()))
+
+
+async def stop_workers() -> None:
+    for worker in _workers:
+        worker.cancel()
+    await asyncio.gather(*_workers, return_exceptions=True)
+    _workers.clear()
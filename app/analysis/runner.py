@@ -0,0 +1,388 @@
+import asyncio
+import datetime
+import os
+import time
+import uuid
+from typing import AsyncIterator, Dict, List, Mapping, Set, Tuple
+
+import httpx
+from fastapi import HTTPException, status
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.sql import select, func, and_
+
+from app.config import IMAGES_FOLDER, MEASUREMENTS_FOLDER
+from app.globals import (
+    ANALYSIS_CLAIM_TTL, ANALYSIS_CLAIM_POLL_INTERVAL, SERVICE_RETRY_BACKOFF
+)
+from app.metrics import Counter
+from app.analysis.balancing import choose_endpoint
+from app.analysis.clients import get_client
+from app.analysis.endpoints import get_endpoints
+from app.analysis.health import get_health, CLOSED, OPEN
+from app.data.database import database, images, results, analysis_claims
+from app.data.io_files import (
+    delete_file, file_size, read_file, save_stream
+)
+from app.data.operations import add_result_image, add_result_file
+
+
+analysis_requests = Counter(
+    'ariavt_analysis_requests_total',
+    'Requests sent to the analysis services, by service and outcome.'
+)
+analysis_retries = Counter(
+    'ariavt_analysis_retries_total',
+    'Failed analysis requests retried, by service.'
+)
+analysis_hedges = Counter(
+    'ariavt_analysis_hedged_requests_total',
+    'Analyses answered while a hedged request was in progress, by service '
+    'and winning request.'
+)
+analyses = Counter(
+    'ariavt_analyses_total',
+    'Analyses run by the services, by service and outcome.'
+)
+
+
+def _multipart_parts(filename: str) -> Tuple[str, bytes, bytes]:
+    """Boundary, head and tail of a multipart body with a single file."""
+    boundary = uuid.uuid4().hex
+    head = (
+        '--{}\r\n'
+        'Content-Disposition: form-data; name="file"; filename="{}"\r\n'
+        'Content-Type: application/octet-stream\r\n\r\n'
+    ).format(boundary, filename).encode()
+    tail = '\r\n--{}--\r\n'.format(boundary).encode()
+    return boundary, head, tail
+
+
+async def _multipart_body(
+        head: bytes, relative_path: str, size: int, tail: bytes
+) -> AsyncIterator[bytes]:
+    yield head
+    async for chunk in read_file(relative_path, size):
+        yield chunk
+    yield tail
+
+
+async def _post_image(
+        db_service: Mapping, url: str, relative_path: str, folder: str
+) -> Tuple[str, bytes]:
+    """Stream an image to an endpoint of an analysis service and its
+    answer to a temporary file in `folder`.
+
+    Returns the relative path of the temporary file and its first bytes.
+    """
+    health = get_health(url)
+    # Not part of the request: a missing image says nothing of the service
+    size = await file_size(relative_path)
+    boundary, head, tail = _multipart_parts(os.path.basename(relative_path))
+    headers = {
+        'accept': 'application/json',
+        'content-type': 'multipart/form-data; boundary={}'.format(boundary),
+        'content-length': str(len(head) + size + len(tail)),
+    }
+    trial = health.state != CLOSED
+    # The trial request may have been taken since the endpoint was chosen
+    if not health.allow_request():
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Service unavailable (circuit open)",
+        )
+    start = time.monotonic()
+    health.outstanding += 1
+    try:
+        # Post data, reusing the pooled connections to the service
+        async with get_client(db_service['id']).stream(
+            'POST',
+            url,
+            content=_multipart_body(head, relative_path, size, tail),
+            headers=headers
+        ) as response:
+            if response.is_error:
+                # Client errors are not a sign of an unhealthy service
+                health.record(
+                    response.status_code < 500, time.monotonic() - start
+                )
+                raise HTTPException(
+                    status_code=status.HTTP_502_BAD_GATEWAY,
+                    detail="Service error: {}".format(response.status_code),
+                )
+            result = await save_stream(response.aiter_bytes(), folder)
+    except httpx.HTTPError as e:
+        health.record(False, time.monotonic() - start)
+        if isinstance(e, httpx.ConnectError):
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Service unavailable",
+            )
+        elif isinstance(e, httpx.TimeoutException):
+            raise HTTPException(
+                status_code=status.HTTP_504_GATEWAY_TIMEOUT,
+                detail="Service timed out",
+            )
+        else:
+            raise HTTPException(
+                status_code=status.HTTP_502_BAD_GATEWAY,
+                detail="Service error: {}".format(e),
+            )
+    finally:
+        health.outstanding -= 1
+        # Whatever the outcome (even a cancellation), so that another
+        # trial request can be let through
+        if trial:
+            health.release_trial()
+    health.record(True, time.monotonic() - start)
+    return result
+
+
+async def _send(
+        db_service: Mapping, url: str, relative_path: str, folder: str
+) -> Tuple[str, bytes]:
+    """`_post_image`, counting the outcome of the request."""
+    try:
+        result = await _post_image(db_service, url, relative_path, folder)
+    except asyncio.CancelledError:
+        analysis_requests.inc(service=db_service['name'], outcome='cancelled')
+        raise
+    except HTTPException:
+        analysis_requests.inc(service=db_service['name'], outcome='failed')
+        raise
+    analysis_requests.inc(service=db_service['name'], outcome='succeeded')
+    return result
+
+
+async def _hedged_post(
+        db_service: Mapping, urls: List[str], tried: Set[str],
+        relative_path: str, folder: str
+) -> Tuple[str, bytes]:
+    """Post an image to the best endpoint not tried yet.
+
+    For services with `hedge`, if the answer takes longer than the 95th
+    percentile of the latency of the endpoint, a duplicate request is
+    sent to another endpoint. The first successful answer wins and the
+    other request is cancelled.
+    """
+    url = choose_endpoint(urls, tried if set(urls) - tried else ())
+    if url is None:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Service unavailable (circuit open)",
+        )
+    tried.add(url)
+    delay = get_health(url).latency(0.95) if db_service['hedge'] else None
+    if delay is None:
+        return await _send(db_service, url, relative_path, folder)
+
+    first = asyncio.ensure_future(
+        _send(db_service, url, relative_path, folder)
+    )
+    tasks = [first]
+    try:
+        await asyncio.wait(tasks, timeout=delay)
+        if not first.done():
+            hedge_url = choose_endpoint(urls, tried)
+            if hedge_url is not None:
+                tried.add(hedge_url)
+                tasks.append(asyncio.ensure_future(
+                    _send(db_service, hedge_url, relative_path, folder)
+                ))
+        pending = set(tasks)
+        while True:
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED
+            )
+            succeeded = [task for task in done if task.exception() is None]
+            if succeeded:
+                winner, *others = succeeded
+                # Both requests answered at once: drop the extra result
+                for task in others:
+                    await delete_file(task.result()[0])
+                if len(tasks) > 1:
+                    analysis_hedges.inc(
+                        service=db_service['name'],
+                        winner='first' if winner is first else 'hedge'
+                    )
+                return winner.result()
+            if not pending:
+                raise done.pop().exception()
+    finally:
+        pending = [task for task in tasks if not task.done()]
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.wait(pending)
+
+
+async def _post_with_policy(
+        db_service: Mapping, relative_path: str, folder: str
+) -> Tuple[str, bytes]:
+    """Post an image to a service following its request policy.
+
+    Failed requests are retried up to `max_retries` times, preferably on
+    other endpoints; analyses are idempotent, as their result replaces
+    the previous one. The whole analysis fails with 504 once `deadline`
+    seconds have passed.
+    """
+    endpoints = get_endpoints([db_service])
+    urls = [endpoint['url'] for endpoint in endpoints[db_service['id']]]
+
+    async def post() -> Tuple[str, bytes]:
+        tried: Set[str] = set()
+        retries = 0
+        while True:
+            try:
+                return await _hedged_post(
+                    db_service, urls, tried, relative_path, folder
+                )
+            except HTTPException as e:
+                # Client errors would fail again, and so would a service
+                # whose circuits are all open
+                if (e.status_code < 500 or retries >= db_service['max_retries']
+                        or all(get_health(url).state == OPEN for url in urls)):
+                    raise
+            retries += 1
+            analysis_retries.inc(service=db_service['name'])
+            await asyncio.sleep(SERVICE_RETRY_BACKOFF * 2 ** (retries - 1))
+
+    try:
+        if db_service['deadline'] is None:
+            result = await post()
+        else:
+            result = await asyncio.wait_for(post(), db_service['deadline'])
+    except asyncio.TimeoutError:
+        analyses.inc(service=db_service['name'], outcome='deadline_exceeded')
+        raise HTTPException(
+            status_code=status.HTTP_504_GATEWAY_TIMEOUT,
+            detail="Service deadline exceeded",
+        )
+    except HTTPException:
+        analyses.inc(service=db_service['name'], outcome='failed')
+        raise
+    analyses.inc(service=db_service['name'], outcome='succeeded')
+    return result
+
+
+async def run_analysis(db_service: Mapping, image_id: int) -> Tuple[int, str]:
+    """Send an image to an analysis service and store its result.
+
+    Both the image and the answer are streamed, so neither is held in
+    memory. Returns the id of the stored result and the relative path of
+    its file. Errors are raised as HTTP exceptions: 5xx ones mean the
+    service failed and the analysis may be retried.
+    """
+    if db_service['result_type'] == 'image':
+        folder = IMAGES_FOLDER
+    elif db_service['result_type'] == 'measurement':
+        folder = MEASUREMENTS_FOLDER
+    else:
+        raise HTTPException(
+            status_code=403, detail='Unknown result type'
+        )
+
+    query = select([images.c.relative_path]).where(images.c.id == image_id)
+    db_image = await database.fetch_one(query)
+    if db_image is None:
+        raise HTTPException(status_code=404, detail="Image not found")
+
+    temp_path, head = await _post_with_policy(
+        db_service, db_image['relative_path'], folder
+    )
+    if db_service['result_type'] == 'image':
+        return await add_result_image(
+            image_id, temp_path, head, db_service['name'], db_service['id']
+        )
+    else:
+        return await add_result_file(
+            image_id, temp_path, db_service['name'], db_service['id']
+        )
+
+
+# Analyses in progress in this process, by image and service id and
+# whether they are forced
+_in_flight: Dict[Tuple[int, int, bool], asyncio.Future] = {}
+
+
+async def _claim(image_id: int, service_id: int, owner: str) -> bool:
+    """Try to become the process that runs an analysis.
+
+    Claims left behind by a dead process are taken over once expired.
+    """
+    expires_at = func.now() + datetime.timedelta(seconds=ANALYSIS_CLAIM_TTL)
+    query = pg_insert(analysis_claims).values(
+        image_id=image_id, service_id=service_id, expires_at=expires_at,
+        owner=owner
+    )
+    query = query.on_conflict_do_update(
+        index_elements=[
+            analysis_claims.c.image_id, analysis_claims.c.service_id
+        ],
+        set_=dict(expires_at=expires_at, owner=owner),
+        where=analysis_claims.c.expires_at < func.now(),
+    ).returning(analysis_claims.c.image_id)
+    return await database.fetch_one(query) is not None
+
+
+async def _release(image_id: int, service_id: int, owner: str) -> None:
+    # Unless it expired and was taken over by another process
+    query = analysis_claims.delete().where(
+        and_(
+            analysis_claims.c.image_id == image_id,
+            analysis_claims.c.service_id == service_id,
+            analysis_claims.c.owner == owner,
+        )
+    )
+    await database.execute(query)
+
+
+async def _analyse_claimed(
+        db_service: Mapping, image_id: int, force: bool
+) -> Tuple[int, str]:
+    service_id = db_service['id']
+    owner = uuid.uuid4().hex
+    waited = False
+    while not await _claim(image_id, service_id, owner):
+        waited = True
+        await asyncio.sleep(ANALYSIS_CLAIM_POLL_INTERVAL)
+    try:
+        if waited and not force:
+            # Another process has just run the analysis: use its result
+            query = select(
+                [results.c.id, results.c.relative_path]
+            ).where(
+                and_(
+                    results.c.image_id == image_id,
+                    results.c.service_id == service_id,
+                )
+            )
+            db_result = await database.fetch_one(query)
+            if db_result is not None:
+                return db_result['id'], db_result['relative_path']
+        return await run_analysis(db_service, image_id)
+    finally:
+        await _release(image_id, service_id, owner)
+
+
+async def analyse_image(
+        db_service: Mapping, image_id: int, force: bool = False
+) -> Tuple[int, str]:
+    """`run_analysis`, coalescing identical analyses in progress.
+
+    Concurrent calls for the same image and service in this process
+    share one call. Across processes, a claim row makes the others wait
+    and reuse the result instead of sending the image again. With
+    `force`, the analysis is run even if another process has just run
+    it, as its result may predate the request.
+    """
+    key = (image_id, db_service['id'], force)
+    future = _in_flight.get(key)
+    if future is None:
+        future = asyncio.ensure_future(
+            _analyse_claimed(db_service, image_id, force)
+        )
+        _in_flight[key] = future
+        future.add_done_callback(lambda _: _in_flight.pop(key, None))
+    # Shielded: a cancelled request must not cancel the analysis other
+    # requests may be waiting for
+    return await asyncio.shield(future)
@@ -0,0 +1,62 @@
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+
+from app.metrics import Counter
+
+
+class TTLCache:
+    """Size-bounded mapping with LRU eviction and expiring entries.
+
+    Entries expire `ttl` seconds after being set (or after their own
+    `ttl`, if given). When the cache is full, the least recently used
+    entry is evicted. Hits and misses are counted, and also reported to
+    the `lookups` counter (by outcome), if given.
+    """
+
+    def __init__(self, maxsize: int, ttl: float,
+                 lookups: Optional[Counter] = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.lookups = lookups
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        entry = self._data.get(key)
+        if entry is not None:
+            expires_at, value = entry
+            if expires_at > time.monotonic():
+                self._data.move_to_end(key)
+                self._count('hit')
+                return value
+            del self._data[key]
+        self._count('miss')
+        return default
+
+    def _count(self, outcome: str) -> None:
+        if outcome == 'hit':
+            self.hits += 1
+        else:
+            self.misses += 1
+        if self.lookups is not None:
+            self.lookups.inc(outcome=outcome)
+
+    def set(self, key: Hashable, value: Any,
+            ttl: Optional[float] = None) -> None:
+        ttl = self.ttl if ttl is None else ttl
+        self._data[key] = (time.monotonic() + ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        entry = self._data.pop(key, None)
+        return default if entry is None else entry[1]
+
+    def clear(self) -> None:
+        self._data.clear()
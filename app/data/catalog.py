@@ -0,0 +1,97 @@
+import asyncio
+from typing import Dict, List, Optional
+
+from sqlalchemy.sql import select
+
+from app.globals import SERVICE_CATALOG_REFRESH_INTERVAL
+from app.data.database import database, services, service_endpoints
+from app.data.notifications import listen, notify
+
+
+# Channel on which changes of the services and their endpoints are
+# notified
+CATALOG_CHANNEL = 'service_catalog'
+
+# Every service by id, and the replicas of each service, loaded from
+# the database at startup and reloaded on every change
+_services: Dict[int, Dict] = {}
+_endpoints: Dict[int, List[Dict]] = {}
+
+# Loads started, and the latest one applied: a slow load must not
+# overwrite the result of a later one
+_loads = 0
+_applied = 0
+
+_refresher: Optional[asyncio.Task] = None
+
+
+async def load_catalog() -> None:
+    global _services, _endpoints, _loads, _applied
+    _loads += 1
+    load = _loads
+    query = select([services]).order_by(services.c.id)
+    db_services = await database.fetch_all(query)
+    query = select([service_endpoints]).order_by(service_endpoints.c.id)
+    db_endpoints = await database.fetch_all(query)
+    if load < _applied:
+        return
+    endpoints = {}
+    for db_endpoint in db_endpoints:
+        endpoints.setdefault(
+            db_endpoint['service_id'], []
+        ).append(dict(db_endpoint))
+    _services = {db_service['id']: dict(db_service)
+                 for db_service in db_services}
+    _endpoints = endpoints
+    _applied = load
+
+
+def get_services() -> List[Dict]:
+    return list(_services.values())
+
+
+def find_service(service_id: int) -> Optional[Dict]:
+    return _services.get(service_id)
+
+
+def get_service_replicas(service_id: int) -> List[Dict]:
+    """Endpoints of a service besides its own URL."""
+    return _endpoints.get(service_id, [])
+
+
+async def catalog_changed() -> None:
+    """Reload the catalog after a change, and make every other process
+    reload it too.
+    """
+    await load_catalog()
+    await notify(CATALOG_CHANNEL)
+
+
+async def _reload() -> None:
+    try:
+        await load_catalog()
+    except Exception as e:
+        print('Service catalog reload error: {!r}'.format(e))
+
+
+# Changes made by other processes
+listen(CATALOG_CHANNEL, lambda payload: asyncio.ensure_future(_reload()))
+
+
+async def _refresh() -> None:
+    while True:
+        await asyncio.sleep(SERVICE_CATALOG_REFRESH_INTERVAL)
+        await _reload()
+
+
+def start_refresher() -> None:
+    global _refresher
+    _refresher = asyncio.ensure_future(_refresh())
+
+
+async def stop_refresher() -> None:
+    global _refresher
+    if _refresher is not None:
+        _refresher.cancel()
+        await asyncio.gather(_refresher, return_exceptions=True)
+        _refresher = None
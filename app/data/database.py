@@ -1,14 +1,24 @@
-import time
-
 import databases
 import sqlalchemy
-from sqlalchemy import exc
 
 from app.config import DATABASE_URL
+from app.globals import (
+    DATABASE_POOL_MIN_SIZE, DATABASE_POOL_MAX_SIZE,
+    DATABASE_STATEMENT_CACHE_SIZE, DATABASE_MAX_INACTIVE_CONNECTION_LIFETIME,
+    DATABASE_MAX_QUERIES
+)
 
 # SQLAlchemy specific code
 
-database = databases.Database(DATABASE_URL)
+# Options of the asyncpg connection pool
+database = databases.Database(
+    DATABASE_URL,
+    min_size=DATABASE_POOL_MIN_SIZE,
+    max_size=DATABASE_POOL_MAX_SIZE,
+    statement_cache_size=DATABASE_STATEMENT_CACHE_SIZE,
+    max_inactive_connection_lifetime=DATABASE_MAX_INACTIVE_CONNECTION_LIFETIME,
+    max_queries=DATABASE_MAX_QUERIES,
+)
 
 metadata = sqlalchemy.MetaData()
 
@@ -19,14 +29,32 @@ images = sqlalchemy.Table(
     sqlalchemy.Column("title", sqlalchemy.String),
     sqlalchemy.Column("text", sqlalchemy.String),
     sqlalchemy.Column("relative_path", sqlalchemy.String),
-    sqlalchemy.Column("date", sqlalchemy.String),
+    sqlalchemy.Column("date", sqlalchemy.String, index=True),
+    # File metadata computed while the upload is streamed to disk
+    sqlalchemy.Column("format", sqlalchemy.String),
+    sqlalchemy.Column("size", sqlalchemy.BigInteger),
+    sqlalchemy.Column("sha256", sqlalchemy.String(64)),
     sqlalchemy.Column(
         "user_id", sqlalchemy.Integer, sqlalchemy.ForeignKey("users.id"),
         nullable=False
     ),
     sqlalchemy.Column(
-        "patient_id", sqlalchemy.Integer, sqlalchemy.ForeignKey("patients.id")
+        "patient_id", sqlalchemy.Integer, sqlalchemy.ForeignKey("patients.id"),
+        index=True
     ),
+    # Listings of the images of a user are paginated by id
+    sqlalchemy.Index("ix_images_user_id_id", "user_id", "id"),
+)
+
+# Content-addressed image files, shared by every image row with the same
+# contents. `refcount` is the number of rows of `images` pointing to it.
+blobs = sqlalchemy.Table(
+    "blobs",
+    metadata,
+    sqlalchemy.Column("sha256", sqlalchemy.String(64), primary_key=True),
+    sqlalchemy.Column("relative_path", sqlalchemy.String, nullable=False),
+    sqlalchemy.Column("size", sqlalchemy.BigInteger, nullable=False),
+    sqlalchemy.Column("refcount", sqlalchemy.Integer, nullable=False),
 )
 
 users = sqlalchemy.Table(
@@ -43,6 +71,39 @@ users = sqlalchemy.Table(
     sqlalchemy.Column("role", sqlalchemy.String, nullable=False),
 )
 
+# Refresh tokens, stored by their SHA-256 digest. Each one is used once:
+# refreshing an access token revokes it and issues a new one.
+refresh_tokens = sqlalchemy.Table(
+    "refresh_tokens",
+    metadata,
+    sqlalchemy.Column("id", sqlalchemy.Integer, primary_key=True),
+    sqlalchemy.Column(
+        "token_hash", sqlalchemy.String(64), nullable=False, unique=True,
+        index=True
+    ),
+    sqlalchemy.Column(
+        "user_id", sqlalchemy.Integer,
+        sqlalchemy.ForeignKey("users.id", ondelete="CASCADE"),
+        nullable=False, index=True
+    ),
+    sqlalchemy.Column(
+        "expires_at", sqlalchemy.DateTime(timezone=True), nullable=False
+    ),
+    sqlalchemy.Column(
+        "revoked", sqlalchemy.Boolean, nullable=False, default=False,
+        server_default=sqlalchemy.false()
+    ),
+    # Revoked because it was used to get a new one (not by a logout)
+    sqlalchemy.Column(
+        "rotated", sqlalchemy.Boolean, nullable=False, default=False,
+        server_default=sqlalchemy.false()
+    ),
+    sqlalchemy.Column(
+        "created_at", sqlalchemy.DateTime(timezone=True), nullable=False,
+        server_default=sqlalchemy.func.now()
+    ),
+)
+
 services = sqlalchemy.Table(
     "services",
     metadata,
@@ -51,9 +112,38 @@ services = sqlalchemy.Table(
         "name", sqlalchemy.String, unique=True, nullable=False, index=True
     ),
     sqlalchemy.Column("url", sqlalchemy.String, nullable=False),
+    # URL probed to check the health of the service, `url` if not set
+    sqlalchemy.Column("health_url", sqlalchemy.String),
     sqlalchemy.Column("result_type", sqlalchemy.String, nullable=False),
     sqlalchemy.Column("full_name", sqlalchemy.String),
     sqlalchemy.Column("description", sqlalchemy.String),
+    # Request policy: seconds an analysis may take in total (no limit if
+    # not set), retries of failed requests and whether a duplicate request
+    # is sent to another replica when the first one is slower than usual
+    sqlalchemy.Column("deadline", sqlalchemy.Float),
+    sqlalchemy.Column(
+        "max_retries", sqlalchemy.Integer, nullable=False, default=0,
+        server_default="0"
+    ),
+    sqlalchemy.Column(
+        "hedge", sqlalchemy.Boolean, nullable=False, default=False,
+        server_default=sqlalchemy.false()
+    ),
+)
+
+# Additional replicas of a service, besides its own `url`
+service_endpoints = sqlalchemy.Table(
+    "service_endpoints",
+    metadata,
+    sqlalchemy.Column("id", sqlalchemy.Integer, primary_key=True),
+    sqlalchemy.Column(
+        "service_id", sqlalchemy.Integer,
+        sqlalchemy.ForeignKey("services.id", ondelete="CASCADE"),
+        nullable=False, index=True
+    ),
+    sqlalchemy.Column("url", sqlalchemy.String, nullable=False),
+    sqlalchemy.Column("health_url", sqlalchemy.String),
+    sqlalchemy.UniqueConstraint("service_id", "url"),
 )
 
 results = sqlalchemy.Table(
@@ -69,6 +159,11 @@ results = sqlalchemy.Table(
         "service_id", sqlalchemy.Integer, sqlalchemy.ForeignKey("services.id"),
         nullable=False
     ),
+    # A single result per image and service
+    sqlalchemy.Index(
+        "ix_results_image_id_service_id", "image_id", "service_id",
+        unique=True
+    ),
 )
 
 patients = sqlalchemy.Table(
@@ -80,13 +175,94 @@ patients = sqlalchemy.Table(
     ),
 )
 
+# Image selections shared by every worker (see app.data.selections)
+selections = sqlalchemy.Table(
+    "selections",
+    metadata,
+    sqlalchemy.Column("hash", sqlalchemy.String, primary_key=True),
+    sqlalchemy.Column(
+        "ids", sqlalchemy.ARRAY(sqlalchemy.Integer), nullable=False
+    ),
+    sqlalchemy.Column(
+        "expires_at", sqlalchemy.DateTime(timezone=True), nullable=False,
+        index=True
+    ),
+    sqlalchemy.Column(
+        "last_used", sqlalchemy.DateTime(timezone=True), nullable=False,
+        index=True
+    ),
+)
+
+# Queue of analyses run in the background (see app.analysis.jobs)
+jobs = sqlalchemy.Table(
+    "jobs",
+    metadata,
+    sqlalchemy.Column("id", sqlalchemy.Integer, primary_key=True),
+    sqlalchemy.Column(
+        "service_id", sqlalchemy.Integer,
+        sqlalchemy.ForeignKey("services.id", ondelete="CASCADE"),
+        nullable=False
+    ),
+    sqlalchemy.Column(
+        "image_id", sqlalchemy.Integer,
+        sqlalchemy.ForeignKey("images.id", ondelete="CASCADE"),
+        nullable=False
+    ),
+    sqlalchemy.Column(
+        "user_id", sqlalchemy.Integer,
+        sqlalchemy.ForeignKey("users.id", ondelete="CASCADE"),
+        nullable=False
+    ),
+    # queued, running, done or failed
+    sqlalchemy.Column("status", sqlalchemy.String, nullable=False),
+    sqlalchemy.Column("attempts", sqlalchemy.Integer, nullable=False),
+    sqlalchemy.Column("max_attempts", sqlalchemy.Integer, nullable=False),
+    sqlalchemy.Column(
+        "run_after", sqlalchemy.DateTime(timezone=True), nullable=False
+    ),
+    sqlalchemy.Column("locked_until", sqlalchemy.DateTime(timezone=True)),
+    # Run the analysis even if another process has just run it
+    sqlalchemy.Column(
+        "force", sqlalchemy.Boolean, nullable=False, server_default='false'
+    ),
+    sqlalchemy.Column("result_id", sqlalchemy.Integer),
+    sqlalchemy.Column("error", sqlalchemy.String),
+    sqlalchemy.Column(
+        "created_at", sqlalchemy.DateTime(timezone=True), nullable=False
+    ),
+    sqlalchemy.Column(
+        "updated_at", sqlalchemy.DateTime(timezone=True), nullable=False
+    ),
+    sqlalchemy.Index("ix_jobs_status_run_after", "status", "run_after"),
+)
+
+# Analyses in progress, one row per image and service, so identical
+# analyses requested from different processes run only once
+analysis_claims = sqlalchemy.Table(
+    "analysis_claims",
+    metadata,
+    sqlalchemy.Column(
+        "image_id", sqlalchemy.Integer,
+        sqlalchemy.ForeignKey("images.id", ondelete="CASCADE"),
+        primary_key=True
+    ),
+    sqlalchemy.Column(
+        "service_id", sqlalchemy.Integer,
+        sqlalchemy.ForeignKey("services.id", ondelete="CASCADE"),
+        primary_key=True
+    ),
+    sqlalchemy.Column(
+        "expires_at", sqlalchemy.DateTime(timezone=True), nullable=False
+    ),
+    # Random token of the claim, so only its owner releases it
+    sqlalchemy.Column("owner", sqlalchemy.String(32), nullable=False),
+)
 
-# Wait until the database is available
-created = False
-while not created:
-    try:
-        engine = sqlalchemy.create_engine(DATABASE_URL)
-        metadata.create_all(engine)
-        created = True
-    except exc.OperationalError:
-        time.sleep(5)
+# Version of the schema of the database, in a single row. See
+# app/data/schema.py
+schema_version = sqlalchemy.Table(
+    "schema_version",
+    metadata,
+    sqlalchemy.Column("id", sqlalchemy.Integer, primary_key=True),
+    sqlalchemy.Column("version", sqlalchemy.Integer, nullable=False),
+)
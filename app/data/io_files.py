@@ -1,18 +1,32 @@
+import asyncio
 import json
-from typing import Dict
+from email.utils import formatdate, parsedate_to_datetime
+from typing import AsyncIterator, Dict, List, Optional, Tuple
 import base64
+import hashlib
 import imghdr
+import mimetypes
 import os
 import stat
+import uuid
 
-from fastapi import HTTPException
-from fastapi.responses import FileResponse
+from fastapi import HTTPException, Request, UploadFile
+from fastapi.responses import FileResponse, Response, StreamingResponse
 import aiofiles.os as aio_os
 import aiofiles as aiof
 import aiofiles.os as aiof_os
-from aiofiles.os import stat as aiof_stat
+from aiofiles.os import stat as aiof_stat, wrap as aiof_wrap
 
 from app.config import DATA_FOLDER, IMAGES_FOLDER, MEASUREMENTS_FOLDER
+from app.globals import (
+    UPLOAD_CHUNK_SIZE, BASE64_CHUNK_SIZE, THUMBNAILS_FOLDER
+)
+
+
+aiof_makedirs = aiof_wrap(os.makedirs)
+
+# Bytes needed to sniff the format of an image
+HEAD_SIZE = 32
 
 
 async def file_exists(path: str) -> bool:
@@ -28,7 +42,7 @@ async def file_exists(path: str) -> bool:
 
 
 async def create_folders() -> None:
-    folders_to_create = [IMAGES_FOLDER, MEASUREMENTS_FOLDER]
+    folders_to_create = [IMAGES_FOLDER, MEASUREMENTS_FOLDER, THUMBNAILS_FOLDER]
     for folder in folders_to_create:
         full_path = os.path.join(DATA_FOLDER, folder)
         if not os.path.exists(full_path):
@@ -41,20 +55,257 @@ async def save_file(relative_path: str, contents: bytes) -> None:
         await f.write(contents)
 
 
+def content_path(sha256: str, image_format: str) -> str:
+    """Relative path of the content-addressed copy of an image.
+
+    Files are keyed by their SHA-256 digest and sharded in two levels of
+    subdirectories to keep the folders small.
+    """
+    return os.path.join(
+        IMAGES_FOLDER, sha256[:2], sha256[2:4],
+        '{}.{}'.format(sha256, image_format)
+    )
+
+
+async def save_uploaded_image(
+        file: UploadFile
+) -> Tuple[str, str, str, int]:
+    """Stream an uploaded image to a temporary file chunk by chunk.
+
+    The format is sniffed on the first chunk and the SHA-256 digest and
+    the size are computed while the chunks are written, so the memory
+    used does not depend on the size of the upload.
+
+    Returns the relative path of the temporary file, the image format,
+    the hex SHA-256 digest and the size in bytes.
+    """
+    # Unique temporary name, so concurrent uploads never share it
+    relative_path = os.path.join(
+        IMAGES_FOLDER, '{}.part'.format(uuid.uuid4().hex)
+    )
+    full_path = os.path.join(DATA_FOLDER, relative_path)
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        async with aiof.open(full_path, mode='wb') as f:
+            chunk = await file.read(UPLOAD_CHUNK_SIZE)
+            # Check if uploaded file is actually an image
+            image_format = imghdr.what(None, chunk)
+            if image_format is None:
+                raise HTTPException(status_code=422,
+                                    detail="Uploaded file is not an image")
+            while chunk:
+                digest.update(chunk)
+                size += len(chunk)
+                await f.write(chunk)
+                chunk = await file.read(UPLOAD_CHUNK_SIZE)
+    except BaseException:
+        await delete_file(relative_path)
+        raise
+    return relative_path, image_format, digest.hexdigest(), size
+
+
+async def move_file(relative_path: str, new_relative_path: str) -> None:
+    full_path = os.path.join(DATA_FOLDER, relative_path)
+    new_full_path = os.path.join(DATA_FOLDER, new_relative_path)
+    await aiof_makedirs(os.path.dirname(new_full_path), exist_ok=True)
+    await aiof_os.rename(full_path, new_full_path)
+
+
+async def trash_file(relative_path: str) -> Optional[str]:
+    """Move a file aside, so it can be deleted or restored later.
+
+    Returns the relative path it was moved to, or None if it does not
+    exist.
+    """
+    trash_path = '{}.{}.deleted'.format(relative_path, uuid.uuid4().hex)
+    try:
+        await move_file(relative_path, trash_path)
+    except FileNotFoundError:
+        return None
+    return trash_path
+
+
+async def save_stream(
+        chunks: AsyncIterator[bytes], folder: str
+) -> Tuple[str, bytes]:
+    """Write a stream of chunks to a temporary file in `folder`.
+
+    Returns the relative path of the temporary file and its first bytes,
+    enough to sniff the format of an image.
+    """
+    relative_path = os.path.join(folder, '{}.part'.format(uuid.uuid4().hex))
+    full_path = os.path.join(DATA_FOLDER, relative_path)
+    head = b''
+    try:
+        async with aiof.open(full_path, mode='wb') as f:
+            async for chunk in chunks:
+                if len(head) < HEAD_SIZE:
+                    head += chunk[:HEAD_SIZE - len(head)]
+                await f.write(chunk)
+    except BaseException:
+        await delete_file(relative_path)
+        raise
+    return relative_path, head
+
+
+async def file_size(relative_path: str) -> int:
+    full_path = os.path.join(DATA_FOLDER, relative_path)
+    try:
+        stat_result = await aiof_stat(full_path)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Item not found")
+    return stat_result.st_size
+
+
+async def file_mtime(relative_path: str) -> float:
+    full_path = os.path.join(DATA_FOLDER, relative_path)
+    try:
+        stat_result = await aiof_stat(full_path)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Item not found")
+    return stat_result.st_mtime
+
+
+async def read_file(relative_path: str, size: int) -> AsyncIterator[bytes]:
+    """Read the first `size` bytes of a file in chunks."""
+    full_path = os.path.join(DATA_FOLDER, relative_path)
+    async for chunk in _read_range(full_path, 0, size):
+        yield chunk
+
+
 async def get_json_from_file(relative_path: str) -> Dict:
     full_path = os.path.join(DATA_FOLDER, relative_path)
     async with aiof.open(full_path, mode='r') as fp:
         return json.loads(await fp.read())
 
 
-async def get_file(filename: str) -> FileResponse:
+def _parse_range(range_header: str, size: int) -> Optional[Tuple[int, int]]:
+    """First and last byte of a single `bytes` range.
+
+    Returns None if the header cannot be honoured (unknown unit, several
+    ranges or bad syntax), in which case the whole file is served.
+    Raises a 416 error if the range is not satisfiable.
+    """
+    unit, _, ranges = range_header.partition('=')
+    if unit.strip().lower() != 'bytes' or ',' in ranges:
+        return None
+    first, _, last = ranges.strip().partition('-')
+    try:
+        if first:
+            start = int(first)
+            end = int(last) if last else size - 1
+        else:
+            # Suffix range: the last N bytes
+            start = max(size - int(last), 0)
+            end = size - 1
+    except ValueError:
+        return None
+    if start > end:
+        return None
+    if start >= size:
+        raise HTTPException(
+            status_code=416,
+            detail="Requested range not satisfiable",
+            headers={'content-range': 'bytes */{}'.format(size)},
+        )
+    return start, min(end, size - 1)
+
+
+def _not_modified(request: Request, etag: str, last_modified: float) -> bool:
+    if_none_match = request.headers.get('if-none-match')
+    if if_none_match is not None:
+        # Weak comparison, as mandated for If-None-Match
+        tags = [tag.strip() for tag in if_none_match.split(',')]
+        return '*' in tags or any(
+            tag[2:] == etag if tag.startswith('W/') else tag == etag
+            for tag in tags
+        )
+    if_modified_since = request.headers.get('if-modified-since')
+    if if_modified_since is not None:
+        try:
+            since = parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+        return int(last_modified) <= since
+    return False
+
+
+async def _read_range(path: str, start: int, length: int):
+    async with aiof.open(path, mode='rb') as f:
+        await f.seek(start)
+        while length > 0:
+            chunk = await f.read(min(UPLOAD_CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+
+async def get_file(
+        filename: str,
+        request: Optional[Request] = None,
+        etag: Optional[str] = None,
+        last_modified: Optional[float] = None,
+) -> Response:
+    """Serve a file with validators, conditional and range support.
+
+    The ETag is `etag` when given (e.g. the SHA-256 digest of the
+    contents) or derived from the modification time and size of the
+    file. Last-Modified is `last_modified` when given, for files derived
+    from another one, or the modification time of the file. With a
+    `request`, `If-None-Match`/`If-Modified-Since` are answered with 304
+    and a single byte `Range` with 206.
+    """
     path = os.path.join(DATA_FOLDER, filename)
-    exists = await file_exists(path)
-    if exists:
-        return FileResponse(path)
-    else:
+    try:
+        stat_result = await aiof_stat(path)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Item not found")
+    if not stat.S_ISREG(stat_result.st_mode):
         raise HTTPException(status_code=404, detail="Item not found")
 
+    if etag is None:
+        etag = '{:x}-{:x}'.format(stat_result.st_mtime_ns, stat_result.st_size)
+    etag = '"{}"'.format(etag)
+    if last_modified is None:
+        last_modified = stat_result.st_mtime
+    headers = {
+        'etag': etag,
+        'last-modified': formatdate(last_modified, usegmt=True),
+        'accept-ranges': 'bytes',
+        # Files are only served to authenticated users: do not keep them
+        # in shared caches and revalidate them before reusing them
+        'cache-control': 'private, no-cache',
+    }
+    if request is None:
+        return FileResponse(path, headers=headers, stat_result=stat_result)
+
+    if _not_modified(request, etag, last_modified):
+        return Response(status_code=304, headers=headers)
+
+    range_header = request.headers.get('range')
+    if_range = request.headers.get('if-range')
+    if range_header is not None and if_range in (None, etag):
+        byte_range = _parse_range(range_header, stat_result.st_size)
+        if byte_range is not None:
+            start, end = byte_range
+            length = end - start + 1
+            headers['content-range'] = 'bytes {}-{}/{}'.format(
+                start, end, stat_result.st_size
+            )
+            headers['content-length'] = str(length)
+            media_type = (
+                mimetypes.guess_type(path)[0] or 'application/octet-stream'
+            )
+            return StreamingResponse(
+                _read_range(path, start, length),
+                status_code=206,
+                headers=headers,
+                media_type=media_type,
+            )
+    return FileResponse(path, headers=headers, stat_result=stat_result)
+
 
 async def get_file_bytes(filename: str) -> bytes:
     path = os.path.join(DATA_FOLDER, filename)
@@ -66,16 +317,36 @@ async def get_file_bytes(filename: str) -> bytes:
         raise HTTPException(status_code=404, detail="Item not found")
 
 
-async def get_file_base64(filename: str):
+async def _base64_json_chunks(path: str, image_format: Optional[str]):
+    async with aiof.open(path, mode='rb') as image_file:
+        chunk = await image_file.read(BASE64_CHUNK_SIZE)
+        if image_format is None:
+            image_format = imghdr.what(None, chunk)
+        yield '{{"format": {}, "image": "'.format(
+            json.dumps(image_format)
+        ).encode()
+        while chunk:
+            yield base64.b64encode(chunk)
+            chunk = await image_file.read(BASE64_CHUNK_SIZE)
+        yield b'"}'
+
+
+async def get_file_base64(
+        filename: str, image_format: Optional[str] = None
+) -> StreamingResponse:
+    """Stream a file as a JSON object with its base64 contents.
+
+    The file is read and encoded in chunks. The format is only sniffed
+    from the first chunk when it is not given (e.g. the one stored when
+    the image was uploaded).
+    """
     path = os.path.join(DATA_FOLDER, filename)
     exists = await file_exists(path)
     if exists:
-        with open(path, "rb") as image_file:
-            contents = image_file.read()
-            # Check if uploaded file is actually an image
-            image_format = imghdr.what(None, contents)
-            encoded_image_string = base64.b64encode(contents)
-        return {"image": encoded_image_string, "format": image_format}
+        return StreamingResponse(
+            _base64_json_chunks(path, image_format),
+            media_type='application/json',
+        )
     else:
         raise HTTPException(status_code=404, detail="Item not found")
 
@@ -87,3 +358,27 @@ async def delete_file(relative_path: str) -> None:
     except FileNotFoundError:
         # If the file does not exist, pass
         pass
+
+
+async def delete_files(
+        relative_paths: List[str], concurrency: int
+) -> Tuple[int, int]:
+    """Delete files, at most `concurrency` at a time.
+
+    Returns the number of files deleted and their total size in bytes.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def delete(relative_path: str) -> int:
+        full_path = os.path.join(DATA_FOLDER, relative_path)
+        async with semaphore:
+            try:
+                size = (await aiof_stat(full_path)).st_size
+                await aiof_os.remove(full_path)
+            except FileNotFoundError:
+                return -1
+        return size
+
+    sizes = await asyncio.gather(*(delete(path) for path in relative_paths))
+    deleted = [size for size in sizes if size >= 0]
+    return len(deleted), sum(deleted)
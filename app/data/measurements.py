@@ -0,0 +1,57 @@
+from typing import Dict, List, Optional
+
+from app.globals import MEASUREMENT_CACHE_SIZE, MEASUREMENT_CACHE_TTL
+from app.metrics import Counter
+from app.data.cache import TTLCache
+from app.data.io_files import get_json_from_file
+from app.data.notifications import listen, notify
+
+
+cache_lookups = Counter(
+    'ariavt_measurement_cache_lookups_total',
+    'Lookups of measurement results in the cache, by outcome.'
+)
+
+# Parsed measurement results, by result id
+measurement_cache = TTLCache(
+    MEASUREMENT_CACHE_SIZE, MEASUREMENT_CACHE_TTL, lookups=cache_lookups
+)
+
+# Channel on which changes of the results are notified
+RESULTS_CHANNEL = 'results'
+# Result ids sent in each notification, well below the payload limit
+NOTIFY_BATCH_SIZE = 500
+
+
+async def get_measurement(result_id: int, relative_path: str) -> Dict:
+    measurement = measurement_cache.get(result_id)
+    if measurement is not None:
+        return measurement
+    measurement = await get_json_from_file(relative_path)
+    measurement_cache.set(result_id, measurement)
+    return measurement
+
+
+async def measurements_changed(result_ids: List[int]) -> None:
+    """Drop results from the cache of every process after a change.
+
+    A result keeps its id when it is replaced, so the other processes
+    would serve the previous one until it expires otherwise.
+    """
+    for result_id in result_ids:
+        measurement_cache.pop(result_id)
+    for start in range(0, len(result_ids), NOTIFY_BATCH_SIZE):
+        batch = result_ids[start:start + NOTIFY_BATCH_SIZE]
+        await notify(RESULTS_CHANNEL, ','.join(map(str, batch)))
+
+
+def _forget_measurements(payload: Optional[str]) -> None:
+    # Notifications may have been missed while reconnecting
+    if payload is None:
+        measurement_cache.clear()
+    else:
+        for result_id in payload.split(','):
+            measurement_cache.pop(int(result_id))
+
+
+listen(RESULTS_CHANNEL, _forget_measurements)
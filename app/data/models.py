@@ -1,4 +1,4 @@
-from typing import Optional
+from typing import List, Optional
 import datetime
 
 from pydantic import BaseModel
@@ -15,6 +15,9 @@ class ImageIn(BaseModel):
 class Image(ImageIn):
     id: int
     user_id: int
+    format: Optional[str]
+    size: Optional[int]
+    sha256: Optional[str]
 
 
 class User(BaseModel):
@@ -37,6 +40,37 @@ class Service(BaseModel):
     result_type: str
     full_name: Optional[str] = None
     description: Optional[str] = None
+    health_url: Optional[str] = None
+    deadline: Optional[float] = None
+    max_retries: int = 0
+    hedge: bool = False
+
+
+class ServiceEndpoint(BaseModel):
+    id: int
+    service_id: int
+    url: str
+    health_url: Optional[str] = None
+
+
+class EndpointHealth(BaseModel):
+    url: str
+    # closed (healthy), open (failing fast) or half_open (on trial)
+    state: str
+    requests: int
+    outstanding: int
+    last_probe: Optional[float] = None
+    error_rate: Optional[float] = None
+    latency_p50: Optional[float] = None
+    latency_p95: Optional[float] = None
+
+
+class ServiceHealth(BaseModel):
+    service_id: int
+    name: str
+    # Best state among the endpoints of the service
+    state: str
+    endpoints: List[EndpointHealth]
 
 
 class Result(BaseModel):
@@ -44,3 +78,32 @@ class Result(BaseModel):
     relative_path: str
     image_id: int
     service_id: int
+
+
+class Job(BaseModel):
+    id: int
+    service_id: int
+    image_id: int
+    status: str
+    attempts: int
+    result_id: Optional[int] = None
+    error: Optional[str] = None
+    created_at: datetime.datetime
+    updated_at: datetime.datetime
+
+
+class BatchAnalysisIn(BaseModel):
+    # Images to analyse: a selection or a list of ids
+    selection: Optional[str] = None
+    image_ids: Optional[List[int]] = None
+    service_ids: List[int]
+    force_analysis: bool = False
+
+
+class AnalysisOutcome(BaseModel):
+    image_id: int
+    service_id: int
+    # done, skipped (already analysed), not_found or failed
+    status: str
+    result_id: Optional[int] = None
+    error: Optional[str] = None
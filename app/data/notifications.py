@@ -0,0 +1,74 @@
+import asyncio
+from typing import Callable, Dict, List, Optional
+
+import asyncpg
+
+from app.config import DATABASE_URL
+from app.globals import NOTIFY_KEEPALIVE_INTERVAL
+from app.data.database import database
+
+
+# Callbacks of each channel. They get the payload of the notification,
+# or None after (re)connecting, when notifications may have been missed.
+_callbacks: Dict[str, List[Callable[[Optional[str]], None]]] = {}
+
+_listener: Optional[asyncio.Task] = None
+
+
+def listen(channel: str, callback: Callable[[Optional[str]], None]) -> None:
+    """Call `callback` whenever a change is notified on `channel`, by
+    any process. Must be called before `start_listener`.
+    """
+    _callbacks.setdefault(channel, []).append(callback)
+
+
+async def notify(channel: str, payload: str = '') -> None:
+    """Notify a change to every process listening to `channel`,
+    including this one.
+    """
+    await database.execute(
+        query="SELECT pg_notify(:channel, :payload)",
+        values={'channel': channel, 'payload': payload},
+    )
+
+
+def _dispatch(connection, pid: int, channel: str, payload: str) -> None:
+    for callback in _callbacks.get(channel, []):
+        callback(payload)
+
+
+async def _listen() -> None:
+    # A dedicated connection: pooled ones do not stay subscribed
+    while True:
+        connection = None
+        try:
+            connection = await asyncpg.connect(DATABASE_URL)
+            for channel in _callbacks:
+                await connection.add_listener(channel, _dispatch)
+            for callbacks in _callbacks.values():
+                for callback in callbacks:
+                    callback(None)
+            while True:
+                await asyncio.sleep(NOTIFY_KEEPALIVE_INTERVAL)
+                await connection.execute('SELECT 1')
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print('Notification listener error: {!r}'.format(e))
+        finally:
+            if connection is not None and not connection.is_closed():
+                await connection.close()
+        await asyncio.sleep(NOTIFY_KEEPALIVE_INTERVAL)
+
+
+def start_listener() -> None:
+    global _listener
+    _listener = asyncio.ensure_future(_listen())
+
+
+async def stop_listener() -> None:
+    global _listener
+    if _listener is not None:
+        _listener.cancel()
+        await asyncio.gather(_listener, return_exceptions=True)
+        _listener = None
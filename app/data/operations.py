@@ -1,31 +1,83 @@
+import asyncio
+import collections
 import http
 import json
 import os
 import imghdr
-from pathlib import Path
-from typing import Dict, Tuple, Union
+from typing import Dict, List, Optional, Tuple
 import datetime
 
 from fastapi import File, UploadFile, HTTPException, Form
-from sqlalchemy.sql import select
+import sqlalchemy
+from sqlalchemy.dialects.postgresql import ARRAY, insert as pg_insert
+from sqlalchemy.sql import select, and_, any_, bindparam
 
 from app.config import IMAGES_FOLDER, MEASUREMENTS_FOLDER
+from app.globals import (
+    UPLOAD_CONCURRENCY, DELETE_CONCURRENCY, USER_CACHE_SIZE, USER_CACHE_TTL
+)
+from app.data.cache import TTLCache
 from app.data.models import UserInDB, User
-from app.data.database import database, images, users, results, patients
-from app.data.io_files import save_file, delete_file
+from app.data.database import (
+    database, images, users, results, patients, blobs
+)
+from app.data.measurements import measurements_changed
+from app.data.notifications import listen, notify
+from app.data.thumbnails import delete_thumbnails, thumbnail_key
+from app.data.io_files import (
+    delete_file, delete_files, save_uploaded_image, move_file, trash_file,
+    content_path, get_json_from_file
+)
+
+
+# Users, by username. Authenticating a request does not need a query
+user_cache = TTLCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+
+# Channel on which changes of the users are notified
+USERS_CHANNEL = 'users'
+
+# Drop several references to each blob of a set at once
+RELEASE_BLOBS_QUERY = """
+    UPDATE blobs SET refcount = blobs.refcount - released.count
+    FROM unnest(CAST(:hashes AS varchar[]), CAST(:counts AS integer[]))
+        AS released(sha256, count)
+    WHERE blobs.sha256 = released.sha256
+    RETURNING blobs.sha256, blobs.relative_path, blobs.refcount
+"""
 
 
 async def get_user(username: str) -> UserInDB:
+    user = user_cache.get(username)
+    if user is not None:
+        return user
     query = users.select().where(users.columns.username == username)
     user_dict = await database.fetch_one(query)
     # print(user_dict)
     if user_dict is not None:
         user = UserInDB(**user_dict)
+        user_cache.set(username, user)
     else:
         user = user_dict
     return user
 
 
+async def user_changed(username: str) -> None:
+    """Drop a user from the cache of every process after a change."""
+    user_cache.pop(username)
+    await notify(USERS_CHANNEL, username)
+
+
+def _forget_user(username: Optional[str]) -> None:
+    # Notifications may have been missed while reconnecting
+    if username is None:
+        user_cache.clear()
+    else:
+        user_cache.pop(username)
+
+
+listen(USERS_CHANNEL, _forget_user)
+
+
 async def get_patient_id(patient_nin: str) -> int:
     patient_id = None
     if patient_nin is not None:
@@ -47,6 +99,98 @@ async def get_patient_id(patient_nin: str) -> int:
     return patient_id
 
 
+async def _save_upload(file: UploadFile) -> Dict:
+    print('Writing file {} to disk...'.format(file.filename))
+    temp_path, img_type, sha256, size = await save_uploaded_image(file)
+    return dict(temp_path=temp_path, format=img_type, sha256=sha256,
+                size=size)
+
+
+async def _reference_blobs(uploads: List[Dict], moved: List[str]) -> None:
+    """Reference the content-addressed copies of a set of uploads.
+
+    Blobs that are not stored yet are created by moving the temporary
+    file of one of their uploads into place (the moved paths are added
+    to `moved`). Blobs that already exist only get their reference count
+    increased, so identical uploads cost a metadata update. Each upload
+    gets the `relative_path` of its blob.
+
+    Must run inside the transaction that inserts the image rows: the
+    blob rows stay locked until it ends, so a concurrent deletion cannot
+    unlink a file that is being referenced again.
+    """
+    references = collections.Counter(upload['sha256'] for upload in uploads)
+    first_upload = {}
+    for upload in uploads:
+        first_upload.setdefault(upload['sha256'], upload)
+    # Sorted, so concurrent batches lock the blob rows in the same order
+    values = [
+        dict(
+            sha256=sha256,
+            relative_path=content_path(
+                sha256, first_upload[sha256]['format']
+            ),
+            size=first_upload[sha256]['size'],
+            refcount=references[sha256],
+        )
+        for sha256 in sorted(references)
+    ]
+    query = pg_insert(blobs).values(values)
+    query = query.on_conflict_do_update(
+        index_elements=[blobs.c.sha256],
+        set_=dict(refcount=blobs.c.refcount + query.excluded.refcount),
+    ).returning(blobs.c.sha256, blobs.c.relative_path, blobs.c.refcount)
+    db_blobs = await database.fetch_all(query)
+
+    paths = {}
+    for db_blob in db_blobs:
+        sha256 = db_blob['sha256']
+        paths[sha256] = db_blob['relative_path']
+        # The blob has just been created: store its file
+        if db_blob['refcount'] == references[sha256]:
+            await move_file(
+                first_upload[sha256]['temp_path'], db_blob['relative_path']
+            )
+            moved.append(db_blob['relative_path'])
+    for upload in uploads:
+        upload['relative_path'] = paths[upload['sha256']]
+
+
+async def _insert_images(uploads: List[Dict], rows: List[Dict]) -> List[int]:
+    """Insert the image rows of a set of uploads referencing their blobs.
+
+    Temporary files are always removed, as are the blob files created if
+    the transaction fails, including at commit.
+    """
+    moved = []
+    try:
+        async with database.transaction():
+            await _reference_blobs(uploads, moved)
+            values = [
+                dict(
+                    row,
+                    relative_path=upload['relative_path'],
+                    format=upload['format'],
+                    size=upload['size'],
+                    sha256=upload['sha256'],
+                )
+                for upload, row in zip(uploads, rows)
+            ]
+            query = images.insert().values(values).returning(images.c.id)
+            db_ids = await database.fetch_all(query)
+    except BaseException:
+        # Outside the transaction block, so a failed commit is covered too
+        await asyncio.gather(
+            *(delete_file(relative_path) for relative_path in moved)
+        )
+        raise
+    finally:
+        await asyncio.gather(
+            *(delete_file(upload['temp_path']) for upload in uploads)
+        )
+    return [db_id['id'] for db_id in db_ids]
+
+
 async def add_image(
         file: UploadFile = File(...),
         user: User = None,
@@ -57,123 +201,276 @@ async def add_image(
 ):
     patient_id = await get_patient_id(patient_nin)
 
-    relative_path = os.path.join(IMAGES_FOLDER, file.filename)
-    print('Writing file {} to disk...'.format(file.filename))
-    contents = await file.read()
-    # Check if uploaded file is actually an image
-    img_type = imghdr.what(None, contents)
-    if img_type is None:
-        raise HTTPException(status_code=422,
-                            detail="Uploaded file is not an image")
-    await save_file(relative_path, contents)
-    query = images.insert().values(
+    upload = await _save_upload(file)
+    row = dict(
         title=title,
         text=text,
-        relative_path=relative_path,
         date=image_date,
         user_id=user.id,
         patient_id=patient_id,
     )
-    last_record_id = await database.execute(query)
+    last_record_id, = await _insert_images([upload], [row])
     return last_record_id
 
 
-async def remove_image(id_: int, relative_path: str, user: User) -> None:
-    query = select([images.c.id, images.c.user_id]).where(images.c.id == id_)
-    db_images = await database.fetch_one(query)
-    # If a record is found
-    if db_images is not None:
-        # Do not perform the deletion of an image if the user who
-        # intends to perform the deletion does not own the image
-        if db_images['user_id'] != user.id:
-            raise HTTPException(status_code=http.HTTPStatus.UNAUTHORIZED,
-                                detail="Operation not allowed")
-        # Delete image file from file system
-        await delete_file(relative_path)
-        # Delete image record from images table
-        query = images.delete().where(images.columns.id == id_)
-        await database.execute(query)
-
-
-async def remove_result(
-        result_id: int, original_image_id: int, relative_path: str, user: User
-) -> None:
+async def add_images(
+        files: List[UploadFile],
+        user: User,
+        patient_nin: str = None,
+        image_date: datetime.date = None,
+) -> List[int]:
+    """Store a batch of uploaded images.
+
+    The patient is resolved once for the whole batch, the files are
+    written to disk with bounded concurrency and all the image rows are
+    inserted with a single multi-row INSERT. If any file of the batch
+    fails, nothing is kept.
+    """
+    patient_id = await get_patient_id(patient_nin)
+    semaphore = asyncio.Semaphore(UPLOAD_CONCURRENCY)
+
+    async def store(file: UploadFile) -> Dict:
+        async with semaphore:
+            return await _save_upload(file)
+
+    stored = await asyncio.gather(
+        *(store(file) for file in files), return_exceptions=True
+    )
+    uploads = [upload for upload in stored
+               if not isinstance(upload, BaseException)]
+    errors = [error for error in stored if isinstance(error, BaseException)]
+    if errors:
+        await asyncio.gather(
+            *(delete_file(upload['temp_path']) for upload in uploads)
+        )
+        raise errors[0]
+
+    row = dict(
+        title='',
+        text='',
+        date=image_date,
+        user_id=user.id,
+        patient_id=patient_id,
+    )
+    return await _insert_images(uploads, [row] * len(uploads))
+
+
+def _any(column, ids: List[int]):
+    """`column = ANY(:ids)`, with the ids bound as a single array."""
+    return column == any_(
+        bindparam(None, ids, type_=ARRAY(sqlalchemy.Integer))
+    )
+
+
+async def remove_images(ids: List[int], user: User) -> Dict:
+    """Delete a set of images, their results and their files.
+
+    Ownership is checked once for the whole set, and the rows are
+    deleted in a single transaction. Files are only unlinked once it has
+    committed, with bounded concurrency. Stored images that are no
+    longer referenced are moved aside before it commits, while their
+    blob rows are locked, so an upload of the same contents that waits
+    for them stores its own file (see `_reference_blobs`). They are put
+    back if the transaction fails.
+
+    Returns the ids of the deleted images and the number and size of
+    the deleted files.
+    """
+    # Do not perform the deletion if the user who intends to perform it
+    # does not own every image
     query = select(
-        [images.c.id, images.c.user_id]
-    ).where(images.c.id == original_image_id)
-    db_images = await database.fetch_one(query)
-    # If a record is found
-    if db_images is not None:
-        # Do not perform the deletion of an image if the user who
-        # intends to perform the deletion does not own the image
-        if db_images['user_id'] != user.id:
-            raise HTTPException(
-                status_code=http.HTTPStatus.UNAUTHORIZED,
-                detail="Operation not allowed"
+        [sqlalchemy.func.count()]
+    ).where(
+        and_(_any(images.c.id, ids), images.c.user_id != user.id)
+    )
+    if await database.fetch_val(query):
+        raise HTTPException(status_code=http.HTTPStatus.UNAUTHORIZED,
+                            detail="Operation not allowed")
+
+    unreferenced, trashed = [], []
+    try:
+        async with database.transaction():
+            query = results.delete().where(
+                _any(results.c.image_id, ids)
+            ).returning(results.c.id, results.c.relative_path)
+            db_results = await database.fetch_all(query)
+            query = images.delete().where(
+                _any(images.c.id, ids)
+            ).returning(images.c.id, images.c.relative_path,
+                        images.c.sha256)
+            db_images = await database.fetch_all(query)
+
+            references = collections.Counter(
+                db_image['sha256'] for db_image in db_images
+                if db_image['sha256'] is not None
             )
-        # Delete image file from file system
-        await delete_file(relative_path)
-        # Delete image record from images table
-        query = results.delete().where(results.columns.id == result_id)
-        await database.execute(query)
+            if references:
+                hashes = sorted(references)
+                db_blobs = await database.fetch_all(
+                    query=RELEASE_BLOBS_QUERY,
+                    values=dict(
+                        hashes=hashes,
+                        counts=[references[sha256] for sha256 in hashes],
+                    )
+                )
+                query = blobs.delete().where(
+                    and_(
+                        blobs.c.sha256 == any_(
+                            bindparam(None, hashes,
+                                      type_=ARRAY(sqlalchemy.String))
+                        ),
+                        blobs.c.refcount <= 0
+                    )
+                )
+                await database.execute(query)
+                unreferenced = [
+                    db_blob for db_blob in db_blobs
+                    if db_blob['refcount'] <= 0
+                ]
+                for db_blob in unreferenced:
+                    trash_path = await trash_file(db_blob['relative_path'])
+                    if trash_path is not None:
+                        trashed.append((db_blob['relative_path'], trash_path))
+    except BaseException:
+        # Also covers a failed commit: the rows still reference the files
+        for relative_path, trash_path in trashed:
+            await move_file(trash_path, relative_path)
+        raise
 
+    deleted_files, deleted_bytes = await delete_files(
+        [trash_path for _, trash_path in trashed], DELETE_CONCURRENCY
+    )
+    await asyncio.gather(*(
+        delete_thumbnails(thumbnail_key(None, db_blob['sha256']))
+        for db_blob in unreferenced
+    ))
 
-async def _save_and_insert_result(
+    # Images stored before content addressing own their file
+    legacy_paths = [
+        db_image['relative_path'] for db_image in db_images
+        if db_image['sha256'] is None
+    ]
+    await asyncio.gather(*(
+        delete_thumbnails(thumbnail_key(db_image['id'], None))
+        for db_image in db_images if db_image['sha256'] is None
+    ))
+    await measurements_changed(
+        [db_result['id'] for db_result in db_results]
+    )
+    result_paths = [db_result['relative_path'] for db_result in db_results]
+    files, size = await delete_files(
+        legacy_paths + result_paths, DELETE_CONCURRENCY
+    )
+    return {
+        'removed': sorted(db_image['id'] for db_image in db_images),
+        'deleted_files': deleted_files + files,
+        'deleted_bytes': deleted_bytes + size,
+    }
+
+
+async def _store_result(
         filename: str,
-        relative_path: Union[str, Path],
-        contents: bytes,
+        temp_path: str,
+        relative_path: str,
         image_id: int,
         service_id: int,
 ) -> int:
+    """Store the result of an image and service, replacing the previous
+    one (and its file, if it was stored elsewhere).
+
+    The result file, written to `temp_path`, is moved into place once
+    the row is locked and updated, so readers never see a partially
+    written file and concurrent analyses replace it in turn. If the
+    transaction fails, the file is deleted unless it replaced the one of
+    the previous result.
+    """
     print('Writing file {} to disk...'.format(filename))
-    await save_file(relative_path, contents)
-    query = results.insert().values(
-        relative_path=relative_path,
-        image_id=image_id,
-        service_id=service_id,
-    )
-    last_record_id = await database.execute(query)
+    previous_path = None
+    moved = False
+    try:
+        async with database.transaction():
+            query = select(
+                [results.c.relative_path]
+            ).where(
+                and_(results.c.image_id == image_id,
+                     results.c.service_id == service_id)
+            ).with_for_update()
+            previous_path = await database.fetch_val(query)
+            query = pg_insert(results).values(
+                relative_path=relative_path,
+                image_id=image_id,
+                service_id=service_id,
+            )
+            query = query.on_conflict_do_update(
+                index_elements=[results.c.image_id, results.c.service_id],
+                set_=dict(relative_path=query.excluded.relative_path),
+            ).returning(results.c.id)
+            last_record_id = await database.execute(query)
+            await move_file(temp_path, relative_path)
+            moved = True
+    except BaseException:
+        # Also covers a failed commit
+        if not moved:
+            await delete_file(temp_path)
+        elif relative_path != previous_path:
+            await delete_file(relative_path)
+        raise
+    await measurements_changed([last_record_id])
+    if previous_path is not None and previous_path != relative_path:
+        await delete_file(previous_path)
     return last_record_id
 
 
 async def add_result_image(
         image_id: int,
-        image_bytes: bytes,
+        temp_path: str,
+        head: bytes,
         service_name: str,
         service_id: int,
 ) -> Tuple[int, str]:
-    image_type = imghdr.what(None, image_bytes)
+    """Store an image returned by an analysis service.
+
+    `temp_path` holds the image and `head` its first bytes. Returns the
+    id of the result and the relative path of its file.
+    """
+    image_type = imghdr.what(None, head)
 
     if image_type is None:
+        await delete_file(temp_path)
         raise HTTPException(
             status_code=422,
             detail='Invalid image returned from service'
         )
     filename = f"{image_id}_{service_name}.{image_type}"
     relative_path = os.path.join(IMAGES_FOLDER, filename)
-    last_record_id = await _save_and_insert_result(
-        filename, relative_path, image_bytes, image_id, service_id
+    last_record_id = await _store_result(
+        filename, temp_path, relative_path, image_id, service_id
     )
-    return last_record_id, image_type
+    return last_record_id, relative_path
 
 
 async def add_result_file(
         image_id: int,
-        contents: bytes,
+        temp_path: str,
         service_name: str,
         service_id: int,
-) -> int:
+) -> Tuple[int, str]:
+    """Store the measurements returned by an analysis service.
+
+    `temp_path` holds the measurements. Returns the id of the result and
+    the relative path of its file.
+    """
     try:
-        json.loads(contents)
-    except json.JSONDecodeError:
+        await get_json_from_file(temp_path)
+    except (json.JSONDecodeError, UnicodeDecodeError):
+        await delete_file(temp_path)
         raise HTTPException(
             status_code=422,
             detail='Invalid data returned from service'
         )
     filename = f"{image_id}_{service_name}.json"
     relative_path = os.path.join(MEASUREMENTS_FOLDER, filename)
-    print('Writing file {} to disk...'.format(filename))
-    last_record_id = await _save_and_insert_result(
-        filename, relative_path, contents, image_id, service_id
+    last_record_id = await _store_result(
+        filename, temp_path, relative_path, image_id, service_id
     )
-    return last_record_id
+    return last_record_id, relative_path
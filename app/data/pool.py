@@ -0,0 +1,107 @@
+import asyncio
+import math
+import time
+
+from app.globals import DATABASE_POOL_ACQUIRE_TIMEOUT
+from app.metrics import Counter, Gauge, Histogram
+from app.data.database import database
+
+
+acquired_connections = Gauge(
+    'ariavt_database_connections_acquired',
+    'Database connections in use.'
+)
+waiting_acquires = Gauge(
+    'ariavt_database_connections_waiting',
+    'Queries waiting for a free database connection.'
+)
+acquire_seconds = Histogram(
+    'ariavt_database_connection_acquire_seconds',
+    'Seconds waited for a free database connection.',
+    buckets=(0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10),
+)
+acquire_timeouts = Counter(
+    'ariavt_database_connection_acquire_timeouts_total',
+    'Queries that gave up waiting for a free database connection.'
+)
+
+
+class InstrumentedPool:
+    """asyncpg pool that times out and measures the acquisition of
+    connections. Everything else is delegated to the pool.
+    """
+
+    def __init__(self, pool):
+        self._pool = pool
+
+    def __getattr__(self, name: str):
+        return getattr(self._pool, name)
+
+    def idle_connections(self) -> int:
+        # Public since asyncpg 0.25
+        if hasattr(self._pool, 'get_idle_size'):
+            return self._pool.get_idle_size()
+        # asyncpg 0.23 (see requirements.txt) has no public API for it
+        return sum(
+            1 for holder in self._pool._holders
+            if holder._con is not None and holder._in_use is None
+        )
+
+    async def acquire(self):
+        start = time.monotonic()
+        waiting_acquires.inc()
+        try:
+            connection = await self._pool.acquire(
+                timeout=DATABASE_POOL_ACQUIRE_TIMEOUT
+            )
+        except asyncio.TimeoutError:
+            acquire_timeouts.inc()
+            raise
+        finally:
+            waiting_acquires.dec()
+            acquire_seconds.observe(time.monotonic() - start)
+        acquired_connections.inc()
+        return connection
+
+    async def release(self, connection) -> None:
+        try:
+            await self._pool.release(connection)
+        finally:
+            acquired_connections.dec()
+
+
+def _idle_connections() -> float:
+    pool = getattr(database._backend, '_pool', None)
+    if not isinstance(pool, InstrumentedPool):
+        return 0
+    try:
+        return pool.idle_connections()
+    except Exception:
+        # The internals of another asyncpg version: unknown, rather than
+        # breaking the rendering of every metric
+        return math.nan
+
+
+idle_connections = Gauge(
+    'ariavt_database_connections_idle',
+    'Open database connections not in use.',
+    function=_idle_connections,
+)
+
+
+def instrument_pool() -> None:
+    """Wrap the pool of `database`, once connected.
+
+    The databases package acquires and releases every connection through
+    the pool of its backend, so this sees every query.
+    """
+    backend = database._backend
+    if not hasattr(backend, '_pool'):
+        # A version of databases other than the pinned one (see
+        # requirements.txt): queries still work, unmeasured
+        print('Database pool not instrumented: unknown backend {!r}'.format(
+            backend
+        ))
+        return
+    if not isinstance(backend._pool, InstrumentedPool):
+        backend._pool = InstrumentedPool(backend._pool)
@@ -0,0 +1,149 @@
+import asyncio
+from typing import List
+
+import asyncpg
+import sqlalchemy
+from sqlalchemy.sql import select
+
+from app.config import DATABASE_URL
+from app.globals import (
+    DATABASE_CONNECT_BACKOFF, DATABASE_CONNECT_MAX_BACKOFF, DELETE_CONCURRENCY
+)
+from app.data.database import database, metadata, results, schema_version
+from app.data.io_files import delete_files
+from app.data.pool import instrument_pool
+
+
+# Version of the schema defined in app/data/database.py. Increase it and
+# add its statements to MIGRATIONS whenever the schema changes.
+SCHEMA_VERSION = 3
+
+# Statements that bring tables created by a previous version up to date.
+# New tables are created by `metadata.create_all`, which does not alter
+# existing ones. Every statement must be safe to run again. Statements
+# that return rows return the relative paths of the files they leave
+# behind, which are deleted once the migration has committed.
+MIGRATIONS = {
+    2: [
+        "ALTER TABLE images ADD COLUMN IF NOT EXISTS format VARCHAR",
+        "ALTER TABLE images ADD COLUMN IF NOT EXISTS size BIGINT",
+        "ALTER TABLE images ADD COLUMN IF NOT EXISTS sha256 VARCHAR(64)",
+        "CREATE INDEX IF NOT EXISTS ix_images_date ON images (date)",
+        "CREATE INDEX IF NOT EXISTS ix_images_patient_id "
+        "ON images (patient_id)",
+        "CREATE INDEX IF NOT EXISTS ix_images_user_id_id "
+        "ON images (user_id, id)",
+        "ALTER TABLE services ADD COLUMN IF NOT EXISTS health_url VARCHAR",
+        "ALTER TABLE services ADD COLUMN IF NOT EXISTS deadline FLOAT",
+        "ALTER TABLE services ADD COLUMN IF NOT EXISTS max_retries INTEGER "
+        "NOT NULL DEFAULT 0",
+        "ALTER TABLE services ADD COLUMN IF NOT EXISTS hedge BOOLEAN "
+        "NOT NULL DEFAULT false",
+        # Keep the latest result of each image and service before making
+        # them unique
+        "DELETE FROM results USING results AS newer "
+        "WHERE results.image_id = newer.image_id "
+        "AND results.service_id = newer.service_id "
+        "AND results.id < newer.id "
+        "RETURNING results.relative_path",
+        "CREATE UNIQUE INDEX IF NOT EXISTS ix_results_image_id_service_id "
+        "ON results (image_id, service_id)",
+    ],
+    3: [
+        "ALTER TABLE jobs ADD COLUMN IF NOT EXISTS force BOOLEAN "
+        "NOT NULL DEFAULT false",
+        # Claims only last while an analysis runs: drop the ones without
+        # an owner
+        "DELETE FROM analysis_claims",
+        "ALTER TABLE analysis_claims ADD COLUMN IF NOT EXISTS owner "
+        "VARCHAR(32) NOT NULL",
+        "ALTER TABLE refresh_tokens ADD COLUMN IF NOT EXISTS rotated "
+        "BOOLEAN NOT NULL DEFAULT false",
+    ],
+}
+
+# Key of the advisory lock held while migrating, so a single process
+# migrates when several start at once
+SCHEMA_LOCK_KEY = 4317
+
+
+async def connect_database() -> None:
+    """Connect to the database, waiting for it to be available."""
+    backoff = DATABASE_CONNECT_BACKOFF
+    while True:
+        try:
+            await database.connect()
+            instrument_pool()
+            return
+        except (OSError, asyncpg.PostgresError) as e:
+            print('Database not available ({!r}), retrying in {} s'.format(
+                e, backoff
+            ))
+        await asyncio.sleep(backoff)
+        backoff = min(backoff * 2, DATABASE_CONNECT_MAX_BACKOFF)
+
+
+async def _current_version() -> int:
+    try:
+        version = await database.fetch_val(select([schema_version.c.version]))
+    except asyncpg.UndefinedTableError:
+        return 0
+    return version or 0
+
+
+def _migrate() -> List[str]:
+    """Migrate the schema, returning the paths of the files left behind."""
+    engine = sqlalchemy.create_engine(DATABASE_URL)
+    try:
+        with engine.begin() as connection:
+            connection.execute(
+                "SELECT pg_advisory_xact_lock({})".format(SCHEMA_LOCK_KEY)
+            )
+            # Another process may have migrated while this one waited
+            version = 0
+            if engine.dialect.has_table(connection, schema_version.name):
+                version = connection.execute(
+                    select([schema_version.c.version])
+                ).scalar() or 0
+            if version >= SCHEMA_VERSION:
+                return []
+            metadata.create_all(connection)
+            paths = set()
+            for migration in range(version + 1, SCHEMA_VERSION + 1):
+                for statement in MIGRATIONS.get(migration, []):
+                    result = connection.execute(statement)
+                    if result.returns_rows:
+                        paths.update(row[0] for row in result if row[0])
+            # e.g. the file of a deleted result, reused by the kept one
+            if paths:
+                paths -= {
+                    row[0] for row in connection.execute(
+                        select([results.c.relative_path]).where(
+                            results.c.relative_path.in_(paths)
+                        )
+                    )
+                }
+            connection.execute(schema_version.delete())
+            connection.execute(
+                schema_version.insert().values(id=1, version=SCHEMA_VERSION)
+            )
+        return sorted(paths)
+    finally:
+        engine.dispose()
+
+
+async def init_schema() -> None:
+    """Create or migrate the schema of the database if it is outdated.
+
+    When it is up to date, which is the usual case, this is a single
+    query. Otherwise the DDL runs in a thread, in one transaction, and
+    the files it leaves behind are deleted once it has committed.
+    """
+    if await _current_version() < SCHEMA_VERSION:
+        print('Migrating the database schema to version {}'.format(
+            SCHEMA_VERSION
+        ))
+        paths = await asyncio.get_event_loop().run_in_executor(
+            None, _migrate
+        )
+        await delete_files(paths, DELETE_CONCURRENCY)
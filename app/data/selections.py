@@ -0,0 +1,125 @@
+import datetime
+import hashlib
+from abc import ABC, abstractmethod
+from typing import List, Optional
+
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.sql import select, func, and_
+
+from app.globals import (
+    SELECTION_BACKEND, SELECTION_TTL, SELECTION_MAX_ENTRIES
+)
+from app.data.cache import TTLCache
+from app.data.database import database, selections
+
+
+def selection_hash(ids: List[int]) -> str:
+    # The full digest: selections are deleted in bulk by their hash, so
+    # two selections must never share one
+    return hashlib.sha256(str(ids).encode("utf-8")).hexdigest()
+
+
+class SelectionStore(ABC):
+    """Image selections, identified by a hash of their ids.
+
+    Selections expire `SELECTION_TTL` seconds after being created, and
+    only the `SELECTION_MAX_ENTRIES` most recently used are kept.
+    """
+
+    @abstractmethod
+    async def put(self, ids: List[int]) -> str:
+        pass
+
+    @abstractmethod
+    async def get(self, hash_: str) -> Optional[List[int]]:
+        pass
+
+    @abstractmethod
+    async def delete(self, hash_: str) -> None:
+        pass
+
+
+class MemorySelectionStore(SelectionStore):
+    """Selections kept in the memory of the process.
+
+    Only valid when the application runs in a single worker.
+    """
+
+    def __init__(self):
+        self._selections = TTLCache(SELECTION_MAX_ENTRIES, SELECTION_TTL)
+
+    async def put(self, ids: List[int]) -> str:
+        hash_ = selection_hash(ids)
+        self._selections.set(hash_, ids)
+        return hash_
+
+    async def get(self, hash_: str) -> Optional[List[int]]:
+        return self._selections.get(hash_)
+
+    async def delete(self, hash_: str) -> None:
+        self._selections.pop(hash_)
+
+
+class DatabaseSelectionStore(SelectionStore):
+    """Selections kept in the `selections` table, shared by every
+    worker and replica.
+    """
+
+    async def put(self, ids: List[int]) -> str:
+        hash_ = selection_hash(ids)
+        expires_at = func.now() + datetime.timedelta(seconds=SELECTION_TTL)
+        query = pg_insert(selections).values(
+            hash=hash_, ids=ids, expires_at=expires_at, last_used=func.now()
+        )
+        query = query.on_conflict_do_update(
+            index_elements=[selections.c.hash],
+            set_=dict(
+                ids=query.excluded.ids,
+                expires_at=expires_at,
+                last_used=func.now(),
+            ),
+        )
+        await database.execute(query)
+        await self._prune()
+        return hash_
+
+    async def get(self, hash_: str) -> Optional[List[int]]:
+        query = selections.update().values(
+            last_used=func.now()
+        ).where(
+            and_(selections.c.hash == hash_,
+                 selections.c.expires_at > func.now())
+        ).returning(selections.c.ids)
+        db_selection = await database.fetch_one(query)
+        return None if db_selection is None else db_selection['ids']
+
+    async def delete(self, hash_: str) -> None:
+        query = selections.delete().where(selections.c.hash == hash_)
+        await database.execute(query)
+
+    @staticmethod
+    async def _prune() -> None:
+        query = selections.delete().where(
+            selections.c.expires_at <= func.now()
+        )
+        await database.execute(query)
+        least_recently_used = select(
+            [selections.c.hash]
+        ).order_by(
+            selections.c.last_used.desc()
+        ).offset(SELECTION_MAX_ENTRIES)
+        query = selections.delete().where(
+            selections.c.hash.in_(least_recently_used)
+        )
+        await database.execute(query)
+
+
+def create_selection_store() -> SelectionStore:
+    if SELECTION_BACKEND == 'memory':
+        return MemorySelectionStore()
+    elif SELECTION_BACKEND == 'database':
+        return DatabaseSelectionStore()
+    else:
+        raise ValueError(
+            'Unknown selection backend: {}'.format(SELECTION_BACKEND)
+        )
@@ -0,0 +1,179 @@
+import asyncio
+import glob
+import os
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Optional
+
+from fastapi import HTTPException
+from PIL import Image as PILImage
+from aiofiles.os import wrap as aiof_wrap
+
+from app.config import DATA_FOLDER
+from app.globals import (
+    THUMBNAILS_FOLDER, THUMBNAIL_SIZES, THUMBNAIL_CACHE_MAX_BYTES,
+    THUMBNAIL_WORKERS
+)
+from app.data.io_files import file_exists
+
+
+aiof_utime = aiof_wrap(os.utime)
+
+_executor: Optional[ProcessPoolExecutor] = None
+# Thumbnails being generated, to render each of them only once
+_in_progress: Dict[str, asyncio.Future] = {}
+
+
+def _get_executor() -> ProcessPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(max_workers=THUMBNAIL_WORKERS)
+    return _executor
+
+
+def shutdown_executor() -> None:
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False)
+        _executor = None
+
+
+def thumbnail_key(image_id: int, sha256: Optional[str]) -> str:
+    # Images stored before content addressing have no digest
+    return sha256 if sha256 is not None else 'image-{}'.format(image_id)
+
+
+def thumbnail_size(size: int) -> int:
+    """Smallest available thumbnail size that is at least `size`."""
+    for available_size in THUMBNAIL_SIZES:
+        if available_size >= size:
+            return available_size
+    return THUMBNAIL_SIZES[-1]
+
+
+def _render_thumbnail(source: str, destination: str, size: int) -> None:
+    """Write a JPEG version of `source` that fits in a `size` square.
+
+    Runs in a worker process.
+    """
+    partial_destination = '{}.{}.part'.format(destination, uuid.uuid4().hex)
+    try:
+        with PILImage.open(source) as img:
+            # Let the decoder downscale JPEGs while reading them
+            img.draft('RGB', (size, size))
+            img = img.convert('RGB')
+            img.thumbnail((size, size))
+            img.save(partial_destination, 'JPEG', quality=85, optimize=True)
+        os.replace(partial_destination, destination)
+    finally:
+        if os.path.exists(partial_destination):
+            os.remove(partial_destination)
+
+
+def _evict(folder: str, max_bytes: int, keep: str) -> None:
+    """Remove the least recently used thumbnails beyond `max_bytes`.
+
+    `keep`, the thumbnail just generated, is not removed: it is about to
+    be served.
+    """
+    entries = []
+    kept = 0
+    for entry in os.scandir(folder):
+        if entry.is_file() and not entry.name.endswith('.part'):
+            stat_result = entry.stat()
+            if entry.path == keep:
+                kept = stat_result.st_size
+                continue
+            entries.append(
+                (stat_result.st_mtime, stat_result.st_size, entry.path)
+            )
+    total = kept + sum(entry_size for _, entry_size, _ in entries)
+    for _, entry_size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= entry_size
+
+
+def _delete_thumbnails(folder: str, key: str) -> None:
+    for path in glob.glob(os.path.join(folder, '{}_*'.format(key))):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+async def get_thumbnail_path(
+        relative_path: str, key: str, size: int
+) -> str:
+    """Relative path of the thumbnail of an image, generating it if it is
+    not cached.
+
+    Cached thumbnails are touched when they are used, so eviction drops
+    the least recently used ones first.
+    """
+    size = thumbnail_size(size)
+    thumbnail_relative_path = os.path.join(
+        THUMBNAILS_FOLDER, '{}_{}.jpeg'.format(key, size)
+    )
+    thumbnail_full_path = os.path.join(DATA_FOLDER, thumbnail_relative_path)
+    if await file_exists(thumbnail_full_path):
+        try:
+            await aiof_utime(thumbnail_full_path)
+        except FileNotFoundError:
+            # Evicted meanwhile: generate it again
+            pass
+        else:
+            return thumbnail_relative_path
+
+    source = os.path.join(DATA_FOLDER, relative_path)
+    if not await file_exists(source):
+        raise HTTPException(status_code=404, detail="Item not found")
+
+    future = _in_progress.get(thumbnail_relative_path)
+    if future is None:
+        future = asyncio.ensure_future(
+            _generate(source, thumbnail_relative_path, size)
+        )
+        _in_progress[thumbnail_relative_path] = future
+    try:
+        # Shielded: a cancelled request must not cancel the generation
+        # other requests may be waiting for
+        await asyncio.shield(future)
+    except Exception:
+        raise HTTPException(
+            status_code=422, detail="Thumbnail could not be generated"
+        )
+    return thumbnail_relative_path
+
+
+async def _generate(
+        source: str, thumbnail_relative_path: str, size: int
+) -> None:
+    loop = asyncio.get_event_loop()
+    try:
+        thumbnail_full_path = os.path.join(
+            DATA_FOLDER, thumbnail_relative_path
+        )
+        await loop.run_in_executor(
+            _get_executor(), _render_thumbnail, source, thumbnail_full_path,
+            size
+        )
+        await loop.run_in_executor(
+            None, _evict, os.path.join(DATA_FOLDER, THUMBNAILS_FOLDER),
+            THUMBNAIL_CACHE_MAX_BYTES, thumbnail_full_path
+        )
+    finally:
+        del _in_progress[thumbnail_relative_path]
+
+
+async def delete_thumbnails(key: str) -> None:
+    """Invalidate every cached thumbnail of an image."""
+    loop = asyncio.get_event_loop()
+    await loop.run_in_executor(
+        None, _delete_thumbnails, os.path.join(DATA_FOLDER, THUMBNAILS_FOLDER),
+        key
+    )
@@ -1,3 +1,138 @@
-
 USER_ROLE = 'user'
 ADMIN_ROLE = 'admin'
+
+# Database
+# Seconds before retrying to connect to the database at startup, doubled
+# on every attempt up to DATABASE_CONNECT_MAX_BACKOFF
+DATABASE_CONNECT_BACKOFF = 0.5
+DATABASE_CONNECT_MAX_BACKOFF = 30
+# Connections kept open to the database by each process, at least and at
+# most. Every worker process has its own pool
+DATABASE_POOL_MIN_SIZE = 2
+DATABASE_POOL_MAX_SIZE = 10
+# Seconds a query waits for a free connection before failing
+DATABASE_POOL_ACQUIRE_TIMEOUT = 10
+# Prepared statements cached by each connection (0 disables the cache,
+# e.g. behind pgbouncer in transaction mode)
+DATABASE_STATEMENT_CACHE_SIZE = 100
+# Connections are closed after being idle for this many seconds, and
+# replaced after running this many queries
+DATABASE_MAX_INACTIVE_CONNECTION_LIFETIME = 300
+DATABASE_MAX_QUERIES = 50000
+
+# Files
+# Size of the chunks in which uploads are streamed to disk
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+# Size of the chunks in which images are read to be sent in base64. A
+# multiple of 3, so the encoded chunks can be concatenated
+BASE64_CHUNK_SIZE = 3 * 256 * 1024
+# Maximum number of files of a batch upload written to disk at once
+UPLOAD_CONCURRENCY = 4
+# Maximum number of files unlinked at once when deleting images
+DELETE_CONCURRENCY = 8
+
+# Thumbnails
+# Folder (inside the data folder) where image derivatives are cached
+THUMBNAILS_FOLDER = 'thumbnails'
+# Sizes (longest side, in pixels) in which thumbnails are generated
+THUMBNAIL_SIZES = (64, 128, 256, 512)
+# Maximum size of the thumbnail cache in bytes
+THUMBNAIL_CACHE_MAX_BYTES = 256 * 1024 * 1024
+# Number of processes that generate thumbnails
+THUMBNAIL_WORKERS = 2
+
+# Image selections
+# Where selections are kept: 'memory' (only valid with a single worker)
+# or 'database' (shared by every worker and replica)
+SELECTION_BACKEND = 'database'
+# Seconds a selection is kept after being created
+SELECTION_TTL = 60 * 60
+# Maximum number of selections kept; the least recently used are evicted
+SELECTION_MAX_ENTRIES = 10000
+
+# Analysis services
+# Maximum connections (and idle keep-alive connections) to each service
+SERVICE_MAX_CONNECTIONS = 20
+SERVICE_MAX_KEEPALIVE_CONNECTIONS = 10
+# Seconds an idle connection is kept alive
+SERVICE_KEEPALIVE_EXPIRY = 60
+# Timeouts, in seconds, to connect to a service and to read its answer
+SERVICE_CONNECT_TIMEOUT = 5
+SERVICE_READ_TIMEOUT = 120
+# Whether to negotiate HTTP/2 with the services (requires httpx[http2])
+SERVICE_HTTP2 = False
+# Seconds before retrying a failed analysis request (for services with
+# `max_retries`), doubled on every retry
+SERVICE_RETRY_BACKOFF = 0.5
+
+# Analysis jobs
+# Number of workers that run queued analyses in each process
+JOB_WORKERS = 4
+# Seconds an idle worker waits before looking for new jobs
+JOB_POLL_INTERVAL = 1
+# Attempts made to run a job before marking it as failed
+JOB_MAX_ATTEMPTS = 5
+# Seconds before the first retry of a failed job, doubled on every
+# attempt up to JOB_RETRY_MAX_BACKOFF
+JOB_RETRY_BACKOFF = 5
+JOB_RETRY_MAX_BACKOFF = 300
+# Seconds a worker owns a running job. The lease is renewed every
+# JOB_HEARTBEAT_INTERVAL seconds while the job runs; jobs whose worker
+# died are run again once it expires
+JOB_LEASE = 60
+JOB_HEARTBEAT_INTERVAL = 20
+# Maximum number of analyses run at once by each service in a batch
+BATCH_ANALYSIS_CONCURRENCY = 4
+# Seconds a process owns an analysis in progress. Other processes wait
+# for it instead of running the same analysis, polling every
+# ANALYSIS_CLAIM_POLL_INTERVAL seconds. Must be longer than any analysis
+ANALYSIS_CLAIM_TTL = 600
+ANALYSIS_CLAIM_POLL_INTERVAL = 0.5
+
+# Authentication
+# Maximum number of users kept in memory, and seconds they are kept.
+# Changes made through the API are applied right away, in every process
+USER_CACHE_SIZE = 1024
+USER_CACHE_TTL = 60
+# Maximum number of verified access tokens kept in memory (each one
+# until it expires)
+TOKEN_CACHE_SIZE = 10000
+# Days a refresh token is valid. Each one can only be used once
+REFRESH_TOKEN_EXPIRE_DAYS = 30
+# Threads that hash and verify passwords, off the event loop
+PASSWORD_HASH_WORKERS = 2
+# Maximum number of password operations running or waiting in each
+# process. Beyond that, requests that need one fail with 429
+PASSWORD_HASH_QUEUE = 32
+
+# Measurements
+# Maximum number of parsed measurement results kept in memory, and
+# seconds they are kept
+MEASUREMENT_CACHE_SIZE = 1024
+MEASUREMENT_CACHE_TTL = 5 * 60
+# Seconds between health probes of every analysis service, and seconds
+# a probe may take
+HEALTH_PROBE_INTERVAL = 15
+HEALTH_PROBE_TIMEOUT = 5
+# Number of recent requests kept to compute latencies and error rates
+HEALTH_WINDOW = 100
+# The circuit of a service opens (requests fail fast with 503) after
+# CIRCUIT_FAILURES consecutive failures, or when at least
+# CIRCUIT_MIN_REQUESTS recent requests have an error rate of
+# CIRCUIT_ERROR_RATE. After CIRCUIT_COOLDOWN seconds a trial request is
+# let through, which closes it again if it succeeds
+CIRCUIT_FAILURES = 5
+CIRCUIT_MIN_REQUESTS = 20
+CIRCUIT_ERROR_RATE = 0.5
+CIRCUIT_COOLDOWN = 30
+# Seconds assumed for the requests to a service endpoint without
+# latency data, when balancing requests among its replicas
+DEFAULT_ENDPOINT_LATENCY = 1
+
+# Change notifications
+# Seconds between checks that the connection listening to change
+# notifications is alive, and before reconnecting when it is not
+NOTIFY_KEEPALIVE_INTERVAL = 30
+# Seconds between reloads of the service catalog, in case a change
+# notification was missed
+SERVICE_CATALOG_REFRESH_INTERVAL = 300
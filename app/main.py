@@ -1,4 +1,8 @@
+import asyncio
+from typing import Optional
+
 from fastapi import FastAPI, Depends
+from fastapi.responses import JSONResponse, PlainTextResponse
 
 from app.routers import security, users, images, services
 
@@ -6,10 +10,19 @@ from app.routers import security, users, images, services
 from fastapi.middleware.cors import CORSMiddleware
 # >
 
+from app.analysis.clients import close_clients
+from app.analysis.health import start_prober, stop_prober
+from app.analysis.jobs import start_workers, stop_workers
+from app.data.catalog import load_catalog, start_refresher, stop_refresher
 from app.data.database import database
 from app.data.io_files import create_folders
+from app.data.notifications import start_listener, stop_listener
+from app.data.schema import connect_database, init_schema
+from app.data.thumbnails import shutdown_executor
+from app.metrics import render_metrics
 from app.security.methods import (
-    create_admin, create_sample_user, get_current_active_user
+    create_admin, create_sample_user, get_current_active_user,
+    shutdown_hashing
 )
 
 app = FastAPI()
@@ -48,19 +61,85 @@ app.include_router(
 )
 
 
+# Connects to the database and starts everything that needs it. Runs in
+# the background, so /ping answers (and /ready fails) until it is done
+_initialisation: Optional[asyncio.Task] = None
+
+
+async def _initialise():
+    try:
+        await connect_database()
+        await init_schema()
+        await create_admin()
+        await create_sample_user()
+        await load_catalog()
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        print('Initialisation error: {!r}'.format(e))
+        raise
+    start_listener()
+    start_refresher()
+    start_workers()
+    start_prober()
+
+
+def initialised() -> bool:
+    return (
+        _initialisation is not None and _initialisation.done()
+        and not _initialisation.cancelled()
+        and _initialisation.exception() is None
+    )
+
+
+async def wait_initialised() -> None:
+    await asyncio.shield(_initialisation)
+
+
 @app.on_event("startup")
 async def startup():
-    await database.connect()
-    await create_admin()
-    await create_sample_user()
+    global _initialisation
     await create_folders()
+    _initialisation = asyncio.ensure_future(_initialise())
 
 
 @app.on_event("shutdown")
 async def shutdown():
-    await database.disconnect()
+    if _initialisation is not None and not _initialisation.done():
+        _initialisation.cancel()
+        await asyncio.gather(_initialisation, return_exceptions=True)
+    await stop_prober()
+    await stop_workers()
+    await stop_refresher()
+    await stop_listener()
+    await close_clients()
+    if database.is_connected:
+        await database.disconnect()
+    shutdown_executor()
+    shutdown_hashing()
 
 
 @app.get("/ping")
 async def ping():
     return {"ping": True}
+
+
+@app.get("/ready")
+async def ready():
+    """Whether this process can serve requests. Unlike `/ping`, it fails
+    until the process is initialised (the database is reachable and its
+    schema is ready) and while the database is not available.
+    """
+    try:
+        ready_ = initialised() and await database.fetch_val("SELECT 1") == 1
+    except Exception:
+        ready_ = False
+    if not ready_:
+        return JSONResponse(status_code=503, content={"ready": False})
+    return {"ready": True}
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    """Metrics of this process, in the Prometheus text format."""
+    return render_metrics()
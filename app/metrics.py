@@ -0,0 +1,133 @@
+from typing import Callable, Dict, List, Optional, Tuple
+
+
+_metrics: List['Metric'] = []
+
+
+class Metric:
+    """Value of the process exported in the Prometheus text format,
+    optionally split by labels.
+    """
+
+    type = 'untyped'
+
+    def __init__(self, name: str, documentation: str):
+        self.name = name
+        self.documentation = documentation
+        self._values: Dict[Tuple[Tuple[str, str], ...], float] = {}
+        _metrics.append(self)
+
+    @staticmethod
+    def _key(labels: Dict) -> Tuple[Tuple[str, str], ...]:
+        return tuple(sorted((name, str(value))
+                            for name, value in labels.items()))
+
+    def get(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self) -> List[Tuple[str, Tuple[Tuple[str, str], ...], float]]:
+        return [(self.name, key, value) for key, value in self._values.items()]
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """Value that goes up and down. With `function`, the value is read
+    from it when the metrics are rendered.
+    """
+
+    type = 'gauge'
+
+    def __init__(self, name: str, documentation: str,
+                 function: Optional[Callable[[], float]] = None):
+        super().__init__(name, documentation)
+        self.function = function
+
+    def set(self, value: float, **labels) -> None:
+        self._values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels) -> None:
+        self.inc(-amount, **labels)
+
+    def get(self, **labels) -> float:
+        if self.function is not None:
+            return self.function()
+        return super().get(**labels)
+
+    def samples(self) -> List[Tuple[str, Tuple[Tuple[str, str], ...], float]]:
+        if self.function is not None:
+            return [(self.name, (), self.function())]
+        return super().samples()
+
+
+class Histogram(Metric):
+    """Distribution of observed values, counted in cumulative buckets."""
+
+    type = 'histogram'
+
+    DEFAULT_BUCKETS = (
+        0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10
+    )
+
+    def __init__(self, name: str, documentation: str,
+                 buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+        # Observations under each bucket bound, by labels. The sum of the
+        # observations is kept as the value of the metric.
+        self._counts: Dict[Tuple[Tuple[str, str], ...], List[int]] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        counts = self._counts.setdefault(key, [0] * len(self.buckets))
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+        self._values[key] = self._values.get(key, 0) + value
+
+    def count(self, **labels) -> int:
+        counts = self._counts.get(self._key(labels))
+        return counts[-1] if counts else 0
+
+    def samples(self) -> List[Tuple[str, Tuple[Tuple[str, str], ...], float]]:
+        samples = []
+        for key, counts in self._counts.items():
+            for bound, count in zip(self.buckets, counts):
+                le = '+Inf' if bound == float('inf') else str(bound)
+                samples.append(
+                    (self.name + '_bucket', key + (('le', le),), count)
+                )
+            samples.append((self.name + '_sum', key, self._values[key]))
+            samples.append((self.name + '_count', key, counts[-1]))
+        return samples
+
+
+def _format_sample(name: str, labels: Tuple[Tuple[str, str], ...],
+                   value: float) -> str:
+    if labels:
+        name += '{{{}}}'.format(','.join(
+            '{}="{}"'.format(
+                label, label_value.replace('\\', '\\\\').replace('"', '\\"')
+            )
+            for label, label_value in labels
+        ))
+    return '{} {}'.format(name, value)
+
+
+def render_metrics() -> str:
+    lines = []
+    for metric in _metrics:
+        lines.append('# HELP {} {}'.format(metric.name, metric.documentation))
+        lines.append('# TYPE {} {}'.format(metric.name, metric.type))
+        lines.extend(_format_sample(*sample) for sample in metric.samples())
+    return '\n'.join(lines) + '\n'
@@ -1,55 +1,171 @@
 from typing import List, Optional
-import hashlib
 import datetime
 
 from fastapi import (
-    APIRouter, File, UploadFile, HTTPException, Query, Form, status
+    APIRouter, File, UploadFile, HTTPException, Query, Form, Request, status
 )
-from fastapi import Depends
-from sqlalchemy.sql import select
+from fastapi import Depends, Response
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from sqlalchemy.sql import select, func
 
 from app.data.models import Image, User
-from app.data.database import database, images, results
-from app.data.io_files import get_file, get_file_base64, get_file_bytes
-from app.data.operations import add_image, get_patient_id, remove_image, remove_result
+from app.data.database import database, images, patients
+from app.data.io_files import (
+    get_file, get_file_base64, get_file_bytes, file_mtime
+)
+from app.data.selections import create_selection_store
+from app.data.thumbnails import (
+    get_thumbnail_path, thumbnail_key, thumbnail_size
+)
+from app.data.operations import (
+    add_image, add_images, get_patient_id, remove_images
+)
 from app.security.methods import get_current_active_user
 
 
 router = APIRouter()
 
-selection = {}
+selection_store = create_selection_store()
+
+
+# Columns that can be requested in a projected listing
+IMAGE_FIELDS = [
+    'id', 'title', 'text', 'relative_path', 'date', 'format', 'size',
+    'sha256', 'user_id', 'patient_nin'
+]
 
 
 @router.get("/", response_model=List[Image])
 async def read_images(
+        response: Response,
         ids: Optional[List[int]] = Query(None),
         user_id: Optional[int] = Query(None),
+        patient_nin: Optional[str] = Query(None),
+        date_from: Optional[datetime.date] = Query(None),
+        date_to: Optional[datetime.date] = Query(None),
+        title: Optional[str] = Query(None),
+        cursor: Optional[int] = Query(None),
+        limit: Optional[int] = Query(None, gt=0, le=1000),
+        fields: Optional[List[str]] = Query(None),
         current_user: User = Depends(get_current_active_user)
 ):
+    """List images, optionally filtered, paginated and projected.
+
+    Pagination is keyset based on the image id: the `X-Next-Cursor`
+    header of a page holds the `cursor` of the next one, and is missing
+    on the last page. With `fields`, only the given fields of each image
+    are returned (`id` is always included).
+    """
+    columns = {
+        column.name: column for column in images.columns
+    }
+    columns['patient_nin'] = patients.c.nin.label('patient_nin')
+    if fields is not None:
+        unknown_fields = set(fields) - set(IMAGE_FIELDS)
+        if unknown_fields:
+            raise HTTPException(
+                status_code=422,
+                detail="Unknown field(s): {}".format(
+                    ', '.join(sorted(unknown_fields))
+                )
+            )
+        selected = ['id'] + [field for field in fields if field != 'id']
+    else:
+        selected = IMAGE_FIELDS
+
+    query = select(
+        [columns[field] for field in selected]
+    ).select_from(
+        images.outerjoin(patients, images.c.patient_id == patients.c.id)
+    )
     if ids is not None:
         # https://stackoverflow.com/questions/8603088/
-        query = select([images]).where(images.c.id.in_(ids))
-        db_images = await database.fetch_all(query)
-        if not db_images:
-            raise HTTPException(status_code=404, detail="Item(s) not found")
-        return db_images
+        query = query.where(images.c.id.in_(ids))
     elif user_id is not None:
-        query = select([images]).where(user_id == images.c.user_id)
-        db_images = await database.fetch_all(query)
-        return db_images
+        query = query.where(user_id == images.c.user_id)
     else:
-        # Return the images ids of the current user
-        query = select([images]).where(current_user.id == images.c.user_id)
-        db_images = await database.fetch_all(query)
-        return db_images
+        # Return the images of the current user
+        query = query.where(current_user.id == images.c.user_id)
+
+    if patient_nin is not None:
+        query = query.where(patients.c.nin == patient_nin)
+    # Dates are stored in ISO format, so they sort as strings
+    if date_from is not None:
+        query = query.where(images.c.date >= date_from.isoformat())
+    if date_to is not None:
+        query = query.where(images.c.date <= date_to.isoformat())
+    if title is not None:
+        query = query.where(
+            func.lower(images.c.title).contains(title.lower(), autoescape=True)
+        )
+    if cursor is not None:
+        query = query.where(images.c.id > cursor)
+    query = query.order_by(images.c.id)
+    if limit is not None:
+        # One more row tells whether there is a next page
+        query = query.limit(limit + 1)
+
+    db_images = await database.fetch_all(query)
+    if ids is not None and not db_images:
+        # An empty page (filtered out, or past the last one) is not an
+        # error, unlike images that do not exist
+        query = select([func.count()]).where(images.c.id.in_(ids))
+        if not await database.fetch_val(query):
+            raise HTTPException(status_code=404, detail="Item(s) not found")
+    headers = {}
+    if limit is not None and len(db_images) > limit:
+        db_images = db_images[:limit]
+        headers['X-Next-Cursor'] = str(db_images[-1]['id'])
+    if fields is not None:
+        # Projected rows do not match the Image model: skip validation
+        return JSONResponse(
+            jsonable_encoder([dict(db_image) for db_image in db_images]),
+            headers=headers,
+        )
+    response.headers.update(headers)
+    return db_images
 
 
 @router.get("/{id_}")
-async def get_image(id_: int):
+async def get_image(id_: int, request: Request):
     query = images.select().where(images.columns.id == id_)
     db_image = await database.fetch_one(query)
     if db_image is not None:
-        return await get_file(db_image['relative_path'])
+        return await get_file(
+            db_image['relative_path'], request, db_image['sha256']
+        )
+    else:
+        raise HTTPException(status_code=404, detail="Item not found")
+
+
+@router.get("/{id_}/thumbnail")
+async def get_image_thumbnail(
+        id_: int,
+        request: Request,
+        size: int = Query(256, gt=0),
+):
+    """Downscaled JPEG version of an image, for galleries and previews.
+
+    The size is rounded up to the closest available thumbnail size.
+    """
+    query = select(
+        [images.c.relative_path, images.c.sha256]
+    ).where(images.c.id == id_)
+    db_image = await database.fetch_one(query)
+    if db_image is not None:
+        key = thumbnail_key(id_, db_image['sha256'])
+        thumbnail_path = await get_thumbnail_path(
+            db_image['relative_path'], key, size
+        )
+        # Cached thumbnails are touched on every use: take the validators
+        # from the image instead, which do not change
+        return await get_file(
+            thumbnail_path,
+            request,
+            etag='{}-{}'.format(key, thumbnail_size(size)),
+            last_modified=await file_mtime(db_image['relative_path']),
+        )
     else:
         raise HTTPException(status_code=404, detail="Item not found")
 
@@ -68,7 +184,9 @@ async def get_image_b64(id_: int):
     query = images.select().where(images.columns.id == id_)
     db_image = await database.fetch_one(query)
     if db_image is not None:
-        return await get_file_base64(db_image['relative_path'])
+        return await get_file_base64(
+            db_image['relative_path'], db_image['format']
+        )
     else:
         raise HTTPException(status_code=404, detail="Item not found")
 
@@ -91,19 +209,17 @@ async def upload_image(
 @router.post("/batch-upload")
 async def upload_images(
         files: List[UploadFile] = File(...),
+        patient_nin: str = Form(None),
+        image_date: datetime.date = Form(None),
         current_user: User = Depends(get_current_active_user)
 ):
-    ids = []
-    for file in files:
-        last_record_id = await add_image(file, current_user)
-        ids.append(last_record_id)
+    ids = await add_images(files, current_user, patient_nin, image_date)
     return {"ids": ids}
 
 
 @router.post("/selection", status_code=201)
 async def select_images(ids: List[int]):
-    selection_hash = hashlib.sha256(str(ids).encode("utf-8")).hexdigest()[:8]
-    selection[selection_hash] = ids
+    selection_hash = await selection_store.put(ids)
     return {'selection': selection_hash}
 
 
@@ -112,24 +228,12 @@ async def delete_images(
         selection_hash: str,
         current_user: User = Depends(get_current_active_user)
 ):
-    # Remove results for the specified images
-    query = select([results], results.c.image_id.in_(selection[selection_hash]))
-    db_results = await database.fetch_all(query)
-    # Remove all selected images
-    for db_result in db_results:
-        await remove_result(
-            db_result['id'], db_result['image_id'], db_result['relative_path'],
-            current_user
-        )
-    # Remove images
-    # Get DB records for given ids
-    query = select([images], images.c.id.in_(selection[selection_hash]))
-    db_results = await database.fetch_all(query)
-    # Remove all selected images
-    for db_result in db_results:
-        await remove_image(db_result['id'], db_result['relative_path'],
-                           current_user)
-    return {'removed': selection[selection_hash]}
+    ids = await selection_store.get(selection_hash)
+    if ids is None:
+        raise HTTPException(status_code=404, detail="Selection not found")
+    removed = await remove_images(ids, current_user)
+    await selection_store.delete(selection_hash)
+    return removed
 
 
 @router.put("/{image_id}")
@@ -1,11 +1,13 @@
 from datetime import timedelta
 
-from fastapi import Depends, HTTPException, status, APIRouter, Header
+from fastapi import Depends, HTTPException, status, APIRouter, Header, Form
 from fastapi.security import OAuth2PasswordRequestForm
 
 from app.config import ACCESS_TOKEN_EXPIRE_MINUTES
 from app.security.methods import (
-    create_access_token, authenticate_user, get_current_user
+    create_access_token, authenticate_user, get_current_user,
+    create_refresh_token, rotate_refresh_token, revoke_refresh_token,
+    delete_expired_refresh_tokens
 )
 from app.security.models import Token
 
@@ -28,7 +30,45 @@ async def login_for_access_token(
     access_token = create_access_token(
         data={"sub": user.username}, expires_delta=access_token_expires
     )
-    return {"access_token": access_token, "token_type": "bearer"}
+    await delete_expired_refresh_tokens(user.id)
+    refresh_token = await create_refresh_token(user.id)
+    return {
+        "access_token": access_token,
+        "token_type": "bearer",
+        "refresh_token": refresh_token,
+    }
+
+
+@router.post("/token/refresh", response_model=Token)
+async def refresh_access_token(refresh_token: str = Form(...)):
+    """Issue a new access token, without the password.
+
+    The refresh token is used up: the response includes a new one.
+    """
+    rotated = await rotate_refresh_token(refresh_token)
+    if rotated is None:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Invalid refresh token",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    username, new_refresh_token = rotated
+    access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
+    access_token = create_access_token(
+        data={"sub": username}, expires_delta=access_token_expires
+    )
+    return {
+        "access_token": access_token,
+        "token_type": "bearer",
+        "refresh_token": new_refresh_token,
+    }
+
+
+@router.post("/token/revoke")
+async def revoke_token(refresh_token: str = Form(...)):
+    """Revoke a refresh token, e.g. on logout."""
+    await revoke_refresh_token(refresh_token)
+    return {"revoked": True}
 
 
 @router.get("/verify-token")
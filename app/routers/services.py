@@ -1,23 +1,31 @@
-import tempfile
-from typing import List, Union, Optional
+import asyncio
+from typing import List, Mapping, Union, Optional
 
 from fastapi import (
-    APIRouter, HTTPException, Form, status, Depends,
+    APIRouter, HTTPException, Form, Request, status, Depends,
 )
 from pydantic.class_validators import Any
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlalchemy.sql import select, and_
-import httpx
-from httpx import AsyncClient
-from starlette.responses import FileResponse
-
-from app.data.io_files import get_file, get_json_from_file
-from app.data.models import User, Service
-from app.data.database import services, images, results
-from app.data.operations import add_result_image, add_result_file
+
+from app.analysis.clients import close_client
+from app.analysis.health import services_health
+from app.analysis.jobs import submit_job, get_job
+from app.analysis.runner import analyse_image
+from app.data.catalog import (
+    catalog_changed, find_service, get_services, get_service_replicas
+)
+from app.data.io_files import get_file
+from app.data.measurements import get_measurement
+from app.data.models import (
+    User, Service, ServiceHealth, ServiceEndpoint, Job, BatchAnalysisIn,
+    AnalysisOutcome
+)
+from app.data.database import services, service_endpoints, images, results
 from app.security.methods import get_current_active_user
-from app.globals import ADMIN_ROLE
+from app.globals import ADMIN_ROLE, BATCH_ANALYSIS_CONCURRENCY
 from app.data.database import database
-from app.routers.images import get_image_bytes
+from app.routers.images import selection_store
 
 
 router = APIRouter()
@@ -30,6 +38,10 @@ async def add_service(
         result_type: str = Form(...),
         full_name: str = Form(...),
         description: Optional[str] = Form(""),
+        health_url: Optional[str] = Form(None),
+        deadline: Optional[float] = Form(None, gt=0),
+        max_retries: int = Form(0, ge=0),
+        hedge: bool = Form(False),
         current_user: User = Depends(get_current_active_user),
 ):
     if result_type not in ['image', 'measurement']:
@@ -46,8 +58,13 @@ async def add_service(
             result_type=result_type,
             full_name=full_name,
             description=description,
+            health_url=health_url,
+            deadline=deadline,
+            max_retries=max_retries,
+            hedge=hedge,
         )
         last_record_id = await database.execute(query)
+        await catalog_changed()
         return {"id": last_record_id}
     else:
         raise HTTPException(
@@ -56,17 +73,105 @@ async def add_service(
         )
 
 
+@router.get("/health", response_model=List[ServiceHealth])
+async def get_services_health():
+    """Health of every service, as seen by this process."""
+    return services_health(get_services())
+
+
+@router.get("/{service_id}/health", response_model=ServiceHealth)
+async def get_service_health(service_id: int):
+    db_service = find_service(service_id)
+    if not db_service:
+        raise HTTPException(status_code=404, detail="Service not found")
+    return services_health([db_service])[0]
+
+
+@router.get("/{service_id}/endpoints", response_model=List[ServiceEndpoint])
+async def get_service_endpoints(service_id: int):
+    """Replicas of a service, besides its own URL."""
+    return get_service_replicas(service_id)
+
+
+@router.post("/{service_id}/endpoints", status_code=201)
+async def add_service_endpoint(
+        service_id: int,
+        url: str = Form(...),
+        health_url: Optional[str] = Form(None),
+        current_user: User = Depends(get_current_active_user),
+):
+    """Add a replica of a service. Requests to the service are balanced
+    among its URL and its replicas.
+    """
+    # Operation only available for admin users
+    if current_user.role != ADMIN_ROLE:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Operation not permitted",
+        )
+    if find_service(service_id) is None:
+        raise HTTPException(status_code=404, detail="Service not found")
+    query = pg_insert(service_endpoints).values(
+        service_id=service_id, url=url, health_url=health_url
+    ).on_conflict_do_nothing().returning(service_endpoints.c.id)
+    endpoint_id = await database.execute(query)
+    if endpoint_id is None:
+        raise HTTPException(
+            status_code=409, detail="Endpoint already exists"
+        )
+    await catalog_changed()
+    return {"id": endpoint_id}
+
+
+@router.delete("/{service_id}/endpoints/{endpoint_id}")
+async def delete_service_endpoint(
+        service_id: int,
+        endpoint_id: int,
+        current_user: User = Depends(get_current_active_user),
+):
+    # Operation only available for admin users
+    if current_user.role != ADMIN_ROLE:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Operation not permitted",
+        )
+    query = service_endpoints.delete().where(
+        and_(
+            service_endpoints.c.id == endpoint_id,
+            service_endpoints.c.service_id == service_id,
+        )
+    ).returning(service_endpoints.c.id)
+    if await database.execute(query) is None:
+        raise HTTPException(status_code=404, detail="Endpoint not found")
+    await catalog_changed()
+    return {"id": endpoint_id}
+
+
+async def serve_result(
+        db_service: Mapping, result_id: int, relative_path: str,
+        request: Request
+):
+    if db_service['result_type'] == 'measurement':
+        return await get_measurement(result_id, relative_path)
+    elif db_service['result_type'] == 'image':
+        return await get_file(relative_path, request)
+    else:
+        raise HTTPException(
+            status_code=403, detail='Unknown result type'
+        )
+
+
 @router.get("/{service_id}", response_model=Union[Service, Any])
 async def get_service(
         service_id: int,
+        request: Request,
         image_id: Optional[int] = None,
         force_analysis: Optional[bool] = False,
         get_only_finished: Optional[bool] = False,
         current_user: User = Depends(get_current_active_user),
 ):
 
-    query = select([services]).where(services.c.id == service_id)
-    db_service = await database.fetch_one(query)
+    db_service = find_service(service_id)
     if not db_service:
         raise HTTPException(status_code=404, detail="Service not found")
 
@@ -103,68 +208,176 @@ async def get_service(
             )
             db_result = await database.fetch_one(query)
             if db_result is not None:
-                if db_service['result_type'] == 'measurement':
-                    return await get_json_from_file(db_result['relative_path'])
-                elif db_service['result_type'] == 'image':
-                    return await get_file(db_result['relative_path'])
-                else:
-                    raise HTTPException(
-                        status_code=403, detail='Unknown result type'
-                    )
+                return await serve_result(
+                    db_service, db_result['id'], db_result['relative_path'],
+                    request
+                )
             else:
                 if get_only_finished:
                     raise HTTPException(
                         status_code=404, detail="Result not found"
                     )
 
-        image = await get_image_bytes(image_id)
+        result_id, relative_path = await analyse_image(
+            db_service, image_id, bool(force_analysis)
+        )
+        return await serve_result(
+            db_service, result_id, relative_path, request
+        )
 
-        async with AsyncClient() as ac:
-            # Build json to post
-            files = {'file': image}
-            # Add necessary 'multipart/form-data' header
-            # headers = token_r.headers.copy()
-            headers = {'accept': 'application/json'}
-            # print('HEADERS', headers)
-            try:
-            # Post data
-                response = await ac.post(
-                    db_service['url'],
-                    files=files,
-                    headers=headers
-                )
-            except httpx.ConnectError:
-                raise HTTPException(
-                    status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
-                    detail="Service unavailable",
-                )
 
-            if db_service['result_type'] == 'image':
-                img_bytes = response.content
+@router.post("/{service_id}/jobs", status_code=202)
+async def submit_analysis(
+        service_id: int,
+        image_id: int,
+        force_analysis: Optional[bool] = False,
+        current_user: User = Depends(get_current_active_user),
+):
+    """Queue the analysis of an image by a service.
 
-                db_id, image_type = await add_result_image(
-                    image_id, img_bytes, db_service['name'], db_service['id']
-                )
+    Returns the id of a job whose status can be polled at
+    `/services/jobs/{job_id}`. Once it is done, the result is served by
+    `/services/{service_id}?image_id=`.
+    """
+    if find_service(service_id) is None:
+        raise HTTPException(status_code=404, detail="Service not found")
+    query = select([images.c.user_id]).where(images.c.id == image_id)
+    db_image = await database.fetch_one(query)
+    if not db_image:
+        raise HTTPException(status_code=404, detail="Image not found")
+    if db_image['user_id'] != current_user.id:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="The user does not own the image.",
+        )
 
-                # Create temporary image file and return it
-                with tempfile.NamedTemporaryFile(
-                    mode='w+b', suffix=f'.{image_type}', delete=False
-                ) as F_OUT:
-                    F_OUT.write(img_bytes)
-                    return FileResponse(
-                        F_OUT.name, media_type=f'image/{image_type}'
-                    )
-            elif db_service['result_type'] == 'measurement':
-                await add_result_file(
-                    image_id, response.content, db_service['name'],
-                    db_service['id']
+    # A result already obtained completes the job right away
+    result_id = None
+    if not force_analysis:
+        query = select(
+            [results.c.id]
+        ).where(
+            and_(
+                results.c.image_id == image_id,
+                results.c.service_id == service_id,
+            )
+        )
+        result_id = await database.fetch_val(query)
+    job_id = await submit_job(
+        service_id, image_id, current_user.id, result_id,
+        bool(force_analysis)
+    )
+    return {"job_id": job_id}
+
+
+@router.get("/jobs/{job_id}", response_model=Job)
+async def get_analysis_job(
+        job_id: int,
+        current_user: User = Depends(get_current_active_user),
+):
+    db_job = await get_job(job_id)
+    if db_job is None or db_job['user_id'] != current_user.id:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return db_job
+
+
+@router.post("/batch", response_model=List[AnalysisOutcome])
+async def analyse_images(
+        batch: BatchAnalysisIn,
+        current_user: User = Depends(get_current_active_user),
+):
+    """Run one or more services over a set of images.
+
+    Images that already have a result of a service are skipped unless
+    the analysis is forced. Each service runs at most
+    `BATCH_ANALYSIS_CONCURRENCY` analyses at once. Returns the outcome
+    of every image and service.
+    """
+    if batch.selection is not None:
+        image_ids = await selection_store.get(batch.selection)
+        if image_ids is None:
+            raise HTTPException(
+                status_code=404, detail="Selection not found"
+            )
+    elif batch.image_ids is not None:
+        image_ids = batch.image_ids
+    else:
+        raise HTTPException(
+            status_code=422, detail="No selection or images given"
+        )
+
+    # Analyse each image once, keeping the order
+    image_ids = list(dict.fromkeys(image_ids))
+
+    db_services = [
+        find_service(service_id)
+        for service_id in dict.fromkeys(batch.service_ids)
+    ]
+    if None in db_services:
+        raise HTTPException(status_code=404, detail="Service not found")
+
+    query = select(
+        [images.c.id, images.c.user_id]
+    ).where(images.c.id.in_(image_ids))
+    db_images = await database.fetch_all(query)
+    if any(db_image['user_id'] != current_user.id for db_image in db_images):
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="The user does not own the image.",
+        )
+    found_ids = {db_image['id'] for db_image in db_images}
+
+    existing = {}
+    if not batch.force_analysis:
+        query = select(
+            [results.c.id, results.c.image_id, results.c.service_id]
+        ).where(
+            and_(
+                results.c.image_id.in_(found_ids),
+                results.c.service_id.in_(batch.service_ids),
+            )
+        )
+        for db_result in await database.fetch_all(query):
+            key = (db_result['image_id'], db_result['service_id'])
+            existing[key] = db_result['id']
+
+    async def analyse(
+            db_service: Mapping, image_id: int, semaphore: asyncio.Semaphore
+    ) -> AnalysisOutcome:
+        outcome = AnalysisOutcome(
+            image_id=image_id, service_id=db_service['id'], status='done'
+        )
+        async with semaphore:
+            try:
+                outcome.result_id, _ = await analyse_image(
+                    db_service, image_id, batch.force_analysis
                 )
-                # Returns the exact answer given by the service
-                return response.json()
+            except HTTPException as e:
+                outcome.status, outcome.error = 'failed', str(e.detail)
+            except Exception as e:
+                outcome.status, outcome.error = 'failed', repr(e)
+        return outcome
+
+    outcomes = []
+    tasks = []
+    for db_service in db_services:
+        semaphore = asyncio.Semaphore(BATCH_ANALYSIS_CONCURRENCY)
+        for image_id in image_ids:
+            key = (image_id, db_service['id'])
+            if image_id not in found_ids:
+                outcomes.append(AnalysisOutcome(
+                    image_id=image_id, service_id=db_service['id'],
+                    status='not_found'
+                ))
+            elif key in existing:
+                outcomes.append(AnalysisOutcome(
+                    image_id=image_id, service_id=db_service['id'],
+                    status='skipped', result_id=existing[key]
+                ))
             else:
-                raise HTTPException(
-                    status_code=403, detail='Unknown result type'
-                )
+                tasks.append(analyse(db_service, image_id, semaphore))
+    outcomes.extend(await asyncio.gather(*tasks))
+    return outcomes
 
 
 @router.delete("/{service_id}")
@@ -174,13 +387,14 @@ async def delete_service(
 ):
     # Operation only available for admin users
     if current_user.role == ADMIN_ROLE:
-        query = select([services]).where(services.c.id == service_id)
-        db_service = await database.fetch_one(query)
+        db_service = find_service(service_id)
         if not db_service:
             raise HTTPException(status_code=404, detail="Service not found")
         else:
             query = services.delete().where(services.columns.id == service_id)
             await database.execute(query)
+            await catalog_changed()
+            await close_client(service_id)
             return {'removed': service_id}
     else:
         raise HTTPException(
@@ -197,6 +411,11 @@ async def update_service(
         result_type: Optional[str] = Form(None),
         full_name: Optional[str] = Form(None),
         description: Optional[str] = Form(None),
+        health_url: Optional[str] = Form(None),
+        # 0 clears the deadline
+        deadline: Optional[float] = Form(None, ge=0),
+        max_retries: Optional[int] = Form(None, ge=0),
+        hedge: Optional[bool] = Form(None),
         current_user: User = Depends(get_current_active_user)
 ):
     values = dict()
@@ -215,6 +434,14 @@ async def update_service(
         values['full_name'] = full_name
     if description:
         values['description'] = description
+    if health_url:
+        values['health_url'] = health_url
+    if deadline is not None:
+        values['deadline'] = deadline or None
+    if max_retries is not None:
+        values['max_retries'] = max_retries
+    if hedge is not None:
+        values['hedge'] = hedge
 
     # Operation only available for admin users
     if current_user.role == ADMIN_ROLE:
@@ -222,6 +449,7 @@ async def update_service(
             **values
         ).where(services.c.id == service_id)
         last_record_id = await database.execute(query)
+        await catalog_changed()
         return {"id": last_record_id}
     else:
         raise HTTPException(
@@ -232,8 +460,7 @@ async def update_service(
 
 @router.get("/", response_model=List[Service])
 async def get_all_services():
-    query = select([services])
-    db_services = await database.fetch_all(query)
+    db_services = get_services()
     if not db_services:
         raise HTTPException(status_code=404, detail="No service found")
     return db_services
@@ -5,10 +5,12 @@ from sqlalchemy.sql import select
 
 from app.data.models import User
 from app.security.methods import (
-    get_current_active_user, get_password_hash, verify_password
+    get_current_active_user, get_password_hash, verify_password,
+    revoke_user_refresh_tokens
 )
 from app.globals import ADMIN_ROLE
 from app.data.database import database, users
+from app.data.operations import user_changed
 
 
 router = APIRouter()
@@ -45,7 +47,7 @@ async def add_user(
         current_user: User = Depends(get_current_active_user)
 ):
     if current_user.role == ADMIN_ROLE:
-        hashed_password = get_password_hash(password)
+        hashed_password = await get_password_hash(password)
 
         query = users.insert().values(
             username=username,
@@ -72,6 +74,7 @@ async def update_user(
         role: str = Form(...),
         old_password: Optional[str] = Form(None),
         password: Optional[str] = Form(None),
+        disabled: Optional[bool] = Form(None),
         current_user: User = Depends(get_current_active_user)
 ):
     # To perform the update, the user/data must meet the following conditions:
@@ -87,9 +90,18 @@ async def update_user(
             disabled=False,
             role=role
         )
+        # Only admins can disable users, and not themselves, so at least
+        # one of them can always log in
+        if disabled is not None and current_user.role == ADMIN_ROLE:
+            if disabled and user_id == current_user.id:
+                raise HTTPException(
+                    status_code=status.HTTP_400_BAD_REQUEST,
+                    detail="Administrators cannot disable themselves",
+                )
+            values.update(disabled=disabled)
 
         if password is not None:
-            hashed_password = get_password_hash(password)
+            hashed_password = await get_password_hash(password)
             if current_user.role == ADMIN_ROLE:
                 values.update(hashed_password=hashed_password)
             else:
@@ -102,7 +114,8 @@ async def update_user(
                         raise HTTPException(
                             status_code=404, detail="User not found")
 
-                    if verify_password(old_password, db_user['hashed_password']):
+                    if await verify_password(
+                            old_password, db_user['hashed_password']):
                         values.update(hashed_password=hashed_password)
                     else:
                         raise HTTPException(
@@ -123,9 +136,15 @@ async def update_user(
 
         query = users.update().values(
             **values
-        ).where(users.c.id == user_id)
-        last_record_id = await database.execute(query)
-        return {"id": last_record_id}
+        ).where(users.c.id == user_id).returning(users.c.id, users.c.username)
+        db_user = await database.fetch_one(query)
+        if db_user is None:
+            return {"id": None}
+        if values['disabled']:
+            # Disabled users cannot get new access tokens either
+            await revoke_user_refresh_tokens(user_id)
+        await user_changed(db_user['username'])
+        return {"id": db_user['id']}
     else:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -164,6 +183,7 @@ async def delete_user(
         else:
             query = users.delete().where(users.columns.id == user_id)
             await database.execute(query)
+            await user_changed(db_user['username'])
             return {'removed': user_id}
     else:
         raise HTTPException(
@@ -1,16 +1,29 @@
 
-from typing import Optional
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Tuple
 from datetime import datetime, timedelta
+import asyncio
+import hashlib
+import secrets
+import time
 
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
 from passlib.context import CryptContext
 from jose import JWTError, jwt
+import sqlalchemy
+from sqlalchemy.sql import select, and_, func
 
-from app.config import SECRET_KEY, ALGORITHM
+from app.config import SECRET_KEY, ALGORITHM, ACCESS_TOKEN_EXPIRE_MINUTES
+from app.globals import (
+    TOKEN_CACHE_SIZE, PASSWORD_HASH_WORKERS, PASSWORD_HASH_QUEUE,
+    REFRESH_TOKEN_EXPIRE_DAYS
+)
+from app.metrics import Counter, Histogram
+from app.data.cache import TTLCache
 from app.security.models import TokenData
-from app.data.operations import get_user
-from app.data.database import users, database
+from app.data.operations import get_user, user_changed
+from app.data.database import users, refresh_tokens, database
 from app.data.models import User
 
 
@@ -18,13 +31,86 @@ pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
+# Threads running bcrypt, created on first use, and operations running or
+# waiting in them
+_executor: Optional[ThreadPoolExecutor] = None
+_pending = 0
 
-def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
+hashing_seconds = Histogram(
+    'ariavt_password_hashing_seconds',
+    'Seconds taken to hash or verify a password, waiting included, by '
+    'operation.'
+)
+hashing_rejected = Counter(
+    'ariavt_password_hashing_rejected_total',
+    'Password operations rejected because too many were waiting.'
+)
 
+# Verified access tokens, until they expire
+token_cache = TTLCache(TOKEN_CACHE_SIZE, ACCESS_TOKEN_EXPIRE_MINUTES * 60)
 
-def get_password_hash(password):
-    return pwd_context.hash(password)
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            max_workers=PASSWORD_HASH_WORKERS,
+            thread_name_prefix='password-hash',
+        )
+    return _executor
+
+
+async def _run_hashing(operation: str, function, *args):
+    """Run a bcrypt operation in the password hashing threads.
+
+    bcrypt takes hundreds of milliseconds on purpose: run on the event
+    loop, it would stall every other request. When too many operations
+    are waiting, the request is rejected with 429 instead.
+    """
+    global _pending
+    if _pending >= PASSWORD_HASH_QUEUE:
+        hashing_rejected.inc()
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="Too many requests",
+            headers={"Retry-After": "1"},
+        )
+    _pending += 1
+    start = time.monotonic()
+    try:
+        return await asyncio.get_event_loop().run_in_executor(
+            _get_executor(), function, *args
+        )
+    finally:
+        _pending -= 1
+        hashing_seconds.observe(time.monotonic() - start, operation=operation)
+
+
+async def verify_password(plain_password, hashed_password):
+    return await _run_hashing(
+        'verify', pwd_context.verify, plain_password, hashed_password
+    )
+
+
+async def verify_and_update_password(plain_password, hashed_password):
+    """Verify a password, and hash it again if its hash uses outdated
+    parameters. Returns whether it is valid and the new hash, if any.
+    """
+    return await _run_hashing(
+        'verify', pwd_context.verify_and_update, plain_password,
+        hashed_password
+    )
+
+
+async def get_password_hash(password):
+    return await _run_hashing('hash', pwd_context.hash, password)
+
+
+def shutdown_hashing() -> None:
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False)
+        _executor = None
 
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
@@ -38,19 +124,124 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     return encoded_jwt
 
 
+def _decode_token(token: str) -> Optional[TokenData]:
+    """Subject of a valid access token, None if it is not valid.
+
+    Valid tokens are remembered until they expire, so they are only
+    verified once.
+    """
+    token_data = token_cache.get(token)
+    if token_data is not None:
+        return token_data
+    try:
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    except JWTError:
+        return None
+    username: str = payload.get("sub")
+    if username is None:
+        return None
+    token_data = TokenData(username=username)
+    expire = payload.get("exp")
+    if expire is not None:
+        token_cache.set(token, token_data, ttl=expire - time.time())
+    return token_data
+
+
+def _hash_refresh_token(token: str) -> str:
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+async def create_refresh_token(user_id: int) -> str:
+    """Issue a refresh token for a user.
+
+    Only its digest is stored: a leak of the table does not leak valid
+    tokens. Tokens are random and long, so no slow hash is needed.
+    """
+    token = secrets.token_urlsafe(32)
+    query = refresh_tokens.insert().values(
+        token_hash=_hash_refresh_token(token),
+        user_id=user_id,
+        expires_at=func.now() + timedelta(days=REFRESH_TOKEN_EXPIRE_DAYS),
+    )
+    await database.execute(query)
+    return token
+
+
+async def rotate_refresh_token(token: str) -> Optional[Tuple[str, str]]:
+    """Revoke a refresh token and issue a new one.
+
+    Returns the username of its user and the new token, or None if the
+    token is not valid. A token that was already rotated means it was
+    stolen (or its new one was): every token of its user is revoked. A
+    token revoked by a logout is only rejected.
+    """
+    token_hash = _hash_refresh_token(token)
+    # Single lookup by the unique index, revoking the token atomically so
+    # it cannot be used twice
+    query = refresh_tokens.update().values(
+        revoked=True, rotated=True
+    ).where(
+        and_(
+            refresh_tokens.c.token_hash == token_hash,
+            refresh_tokens.c.revoked == sqlalchemy.false(),
+            refresh_tokens.c.expires_at > func.now(),
+            refresh_tokens.c.user_id == users.c.id,
+            users.c.disabled.isnot(True),
+        )
+    ).returning(users.c.id, users.c.username)
+    db_user = await database.fetch_one(query)
+    if db_user is None:
+        used = refresh_tokens.alias()
+        query = refresh_tokens.update().values(
+            revoked=True
+        ).where(
+            refresh_tokens.c.user_id == select(
+                [used.c.user_id]
+            ).where(
+                and_(
+                    used.c.token_hash == token_hash,
+                    used.c.rotated == sqlalchemy.true(),
+                )
+            ).as_scalar()
+        )
+        await database.execute(query)
+        return None
+    return db_user['username'], await create_refresh_token(db_user['id'])
+
+
+async def revoke_refresh_token(token: str) -> None:
+    query = refresh_tokens.update().values(
+        revoked=True
+    ).where(refresh_tokens.c.token_hash == _hash_refresh_token(token))
+    await database.execute(query)
+
+
+async def revoke_user_refresh_tokens(user_id: int) -> None:
+    """Revoke every refresh token of a user, e.g. when it is disabled."""
+    query = refresh_tokens.update().values(
+        revoked=True
+    ).where(refresh_tokens.c.user_id == user_id)
+    await database.execute(query)
+
+
+async def delete_expired_refresh_tokens(user_id: int) -> None:
+    query = refresh_tokens.delete().where(
+        and_(
+            refresh_tokens.c.user_id == user_id,
+            refresh_tokens.c.expires_at < func.now(),
+        )
+    )
+    await database.execute(query)
+
+
 async def get_current_user(token: str = Depends(oauth2_scheme)) -> User:
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        username: str = payload.get("sub")
-        if username is None:
-            raise credentials_exception
-        token_data = TokenData(username=username)
-    except JWTError:
+    token_data = _decode_token(token)
+    if token_data is None:
         raise credentials_exception
     user = await get_user(username=token_data.username)
     if user is None:
@@ -67,7 +258,7 @@ async def get_current_active_user(current_user: User = Depends(get_current_user)
 async def create_admin():
     admin_user = await get_user('admin')
     if admin_user is None:
-        hashed_password = get_password_hash('admin')
+        hashed_password = await get_password_hash('admin')
 
         query = users.insert().values(username='admin',
                                       full_name='admin',
@@ -83,7 +274,7 @@ async def create_admin():
 async def create_sample_user():
     admin_user = await get_user('user')
     if admin_user is None:
-        hashed_password = get_password_hash('user')
+        hashed_password = await get_password_hash('user')
 
         query = users.insert().values(username='user',
                                       full_name='user',
@@ -98,7 +289,17 @@ async def authenticate_user(username: str, password: str):
     user = await get_user(username)
     if not user:
         return False
-    if not verify_password(password, user.hashed_password):
+    verified, new_hash = await verify_and_update_password(
+        password, user.hashed_password
+    )
+    if not verified:
         return False
+    if new_hash is not None:
+        # The hashing parameters changed since the password was set
+        query = users.update().values(
+            hashed_password=new_hash
+        ).where(users.c.id == user.id)
+        await database.execute(query)
+        await user_changed(user.username)
     return user
 
@@ -4,12 +4,13 @@ from httpx import AsyncClient
 
 from tests.models_test import AccessToken
 
-from app.main import app
+from app.main import app, wait_initialised
 
 
 @pytest.fixture
 async def client():
     async with LifespanManager(app):
+        await wait_initialised()
         async with AsyncClient(app=app, base_url="http://localhost:8000") as ac:
             yield ac
 
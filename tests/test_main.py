@@ -1,7 +1,15 @@
+import base64
+import glob
+import imghdr
+import os
+
 import pytest
 from http import HTTPStatus as StC
 from httpx import AsyncClient
 
+from app.config import DATA_FOLDER
+from app.globals import THUMBNAILS_FOLDER
+from app.data.thumbnails import _evict
 from tests.models_test import TokenResponse
 from tests.utils import upload_images, upload_single_image, delete_images
 
@@ -28,6 +36,21 @@ async def test_delete_all_images(
     assert 'removed' in response.json()
 
 
+# =====================================================================
+
+@pytest.mark.asyncio
+async def test_ready(client: AsyncClient):
+    response = await client.get("/ready")
+    assert response.status_code == StC.OK
+    assert response.json()['ready']
+
+    # -> Queries go through the instrumented connection pool
+    response = await client.get("/metrics")
+    assert response.status_code == StC.OK
+    assert 'ariavt_database_connection_acquire_seconds_count' in response.text
+    assert 'ariavt_database_connections_idle' in response.text
+
+
 # =====================================================================
 
 @pytest.mark.asyncio
@@ -65,6 +88,65 @@ async def test_verify_token(
     assert response.status_code == StC.UNAUTHORIZED
 
 
+# =====================================================================
+
+@pytest.mark.asyncio
+async def test_refresh_token(client: AsyncClient):
+    response = await client.post(
+        "/token", data={"username": "admin", "password": "admin"}
+    )
+    assert response.status_code == StC.OK
+    refresh_token = response.json()['refresh_token']
+    assert refresh_token
+
+    # -> A new access token and refresh token, without the password
+    response = await client.post(
+        "/token/refresh", data={"refresh_token": refresh_token}
+    )
+    assert response.status_code == StC.OK
+    tokens = response.json()
+    assert tokens['refresh_token'] != refresh_token
+    response = await client.get(
+        "/verify-token",
+        headers={'Authorization': 'Bearer ' + tokens['access_token']}
+    )
+    assert response.status_code == StC.OK
+
+    # -> A refresh token can only be used once. Reusing it revokes the
+    #    tokens issued from it too
+    response = await client.post(
+        "/token/refresh", data={"refresh_token": refresh_token}
+    )
+    assert response.status_code == StC.UNAUTHORIZED
+    response = await client.post(
+        "/token/refresh", data={"refresh_token": tokens['refresh_token']}
+    )
+    assert response.status_code == StC.UNAUTHORIZED
+
+    # -> A token revoked by a logout is rejected, without revoking the
+    #    other sessions of the user
+    response = await client.post(
+        "/token", data={"username": "admin", "password": "admin"}
+    )
+    other_token = response.json()['refresh_token']
+    response = await client.post(
+        "/token", data={"username": "admin", "password": "admin"}
+    )
+    logged_out_token = response.json()['refresh_token']
+    response = await client.post(
+        "/token/revoke", data={"refresh_token": logged_out_token}
+    )
+    assert response.status_code == StC.OK
+    response = await client.post(
+        "/token/refresh", data={"refresh_token": logged_out_token}
+    )
+    assert response.status_code == StC.UNAUTHORIZED
+    response = await client.post(
+        "/token/refresh", data={"refresh_token": other_token}
+    )
+    assert response.status_code == StC.OK
+
+
 # =====================================================================
 
 @pytest.mark.asyncio
@@ -117,7 +199,9 @@ async def test_upload_image(client: AsyncClient, token_r: TokenResponse):
 
     response = await delete_images(client, token_r, ids=[id_])
     assert response.status_code == StC.OK
-    assert 'removed' in response.json()
+    assert response.json()['removed'] == [id_]
+    assert response.json()['deleted_files'] == 1
+    assert response.json()['deleted_bytes'] > 0
 
 
 # =====================================================================
@@ -140,6 +224,7 @@ async def test_upload_and_get_image(client: AsyncClient, token_r: TokenResponse)
     print(response)
     assert response.status_code == StC.OK
     assert type(response.content) == bytes
+    contents = response.content
 
     # -> Get uploaded image base64
 
@@ -147,6 +232,8 @@ async def test_upload_and_get_image(client: AsyncClient, token_r: TokenResponse)
     print(response)
     assert response.status_code == StC.OK
     assert type(response.content) == bytes
+    assert response.json()['format'] == 'png'
+    assert base64.b64decode(response.json()['image']) == contents
 
     # -> Remove the file
 
@@ -299,4 +386,207 @@ async def test_update_image(client: AsyncClient, token_r: TokenResponse):
 
     response = await client.get("/images/{}".format(id_), headers=token_r.headers)
     print(response)
-    assert response.status_code == StC.NOT_FOUND
\ No newline at end of file
+    assert response.status_code == StC.NOT_FOUND
+
+# =====================================================================
+
+@pytest.mark.asyncio
+async def test_get_image_thumbnail(client: AsyncClient, token_r: TokenResponse):
+    image_name = 'c_im0236.png'
+
+    # -> Upload image
+
+    response = await upload_single_image(client, token_r, image_name)
+    assert response.status_code == StC.OK
+    id_ = response.json()['id']
+
+    # -> Get thumbnail (generated, then cached)
+
+    for _ in range(2):
+        response = await client.get(
+            "/images/{}/thumbnail".format(id_),
+            params={'size': 100},
+            headers=token_r.headers
+        )
+        print(response)
+        assert response.status_code == StC.OK
+        assert imghdr.what(None, response.content) == 'jpeg'
+
+    # -> Revalidate the cached thumbnail
+
+    response = await client.get(
+        "/images/{}/thumbnail".format(id_),
+        params={'size': 100},
+        headers={**token_r.headers, 'If-None-Match': response.headers['etag']}
+    )
+    assert response.status_code == StC.NOT_MODIFIED
+
+    original = await client.get(
+        "/images/{}".format(id_), headers=token_r.headers
+    )
+    thumbnail = await client.get(
+        "/images/{}/thumbnail".format(id_),
+        params={'size': 100},
+        headers=token_r.headers
+    )
+    assert len(thumbnail.content) < len(original.content)
+
+    response = await client.get(
+        "/images/",
+        params={'ids': [id_], 'fields': ['sha256']},
+        headers=token_r.headers
+    )
+    thumbnails = os.path.join(
+        DATA_FOLDER, THUMBNAILS_FOLDER,
+        '{}_*'.format(response.json()[0]['sha256'])
+    )
+    assert glob.glob(thumbnails)
+
+    # -> Remove the image, and its cached thumbnails
+
+    response = await delete_images(client, token_r, ids=[id_])
+    assert response.status_code == StC.OK
+    assert not glob.glob(thumbnails)
+
+    response = await client.get(
+        "/images/{}/thumbnail".format(id_), headers=token_r.headers
+    )
+    assert response.status_code == StC.NOT_FOUND
+
+
+def test_thumbnail_eviction_keeps_new_thumbnail(tmp_path):
+    # The thumbnail just generated is not evicted before it is served,
+    # even if it is the least recently used one
+    paths = []
+    for i in range(3):
+        path = tmp_path / 'key{}_64.jpeg'.format(i)
+        path.write_bytes(bytes(100))
+        os.utime(path, (i, i))
+        paths.append(str(path))
+    _evict(str(tmp_path), 150, paths[0])
+    assert os.path.exists(paths[0])
+    assert not os.path.exists(paths[1])
+    assert not os.path.exists(paths[2])
+
+
+# =====================================================================
+
+@pytest.mark.asyncio
+async def test_get_image_conditional_and_range(
+        client: AsyncClient, token_r: TokenResponse):
+    image_name = 'c_im0236.png'
+
+    # -> Upload image
+
+    response = await upload_single_image(client, token_r, image_name)
+    assert response.status_code == StC.OK
+    id_ = response.json()['id']
+
+    # -> Get image with validators
+
+    response = await client.get(
+        "/images/{}".format(id_), headers=token_r.headers
+    )
+    assert response.status_code == StC.OK
+    assert 'etag' in response.headers
+    assert 'last-modified' in response.headers
+    contents = response.content
+
+    # -> Conditional requests
+
+    headers = token_r.headers.copy()
+    headers['If-None-Match'] = response.headers['etag']
+    response = await client.get("/images/{}".format(id_), headers=headers)
+    assert response.status_code == StC.NOT_MODIFIED
+
+    headers = token_r.headers.copy()
+    headers['If-None-Match'] = '"other"'
+    response = await client.get("/images/{}".format(id_), headers=headers)
+    assert response.status_code == StC.OK
+
+    # -> Range requests
+
+    headers = token_r.headers.copy()
+    headers['Range'] = 'bytes=0-99'
+    response = await client.get("/images/{}".format(id_), headers=headers)
+    assert response.status_code == StC.PARTIAL_CONTENT
+    assert response.content == contents[:100]
+    assert response.headers['content-range'] == 'bytes 0-99/{}'.format(
+        len(contents)
+    )
+
+    headers['Range'] = 'bytes=-10'
+    response = await client.get("/images/{}".format(id_), headers=headers)
+    assert response.status_code == StC.PARTIAL_CONTENT
+    assert response.content == contents[-10:]
+
+    headers['Range'] = 'bytes={}-'.format(len(contents))
+    response = await client.get("/images/{}".format(id_), headers=headers)
+    assert response.status_code == StC.REQUESTED_RANGE_NOT_SATISFIABLE
+
+    # -> Remove the image
+
+    response = await delete_images(client, token_r, ids=[id_])
+    assert response.status_code == StC.OK
+
+
+# =====================================================================
+
+@pytest.mark.asyncio
+async def test_get_images_paginated(
+        client: AsyncClient, token_r: TokenResponse):
+    image_names = ['c_im0236.png', 'c_im0237.png', 'c_im0238.png']
+
+    # -> Upload images
+
+    response = await upload_images(client, token_r, image_names)
+    assert response.status_code == StC.OK
+    ids = response.json()['ids']
+
+    # -> Get images page by page
+
+    params = {'ids': ids, 'limit': 2}
+    response = await client.get(
+        "/images/", params=params, headers=token_r.headers
+    )
+    assert response.status_code == StC.OK
+    assert [image['id'] for image in response.json()] == sorted(ids)[:2]
+    cursor = response.headers['X-Next-Cursor']
+
+    params['cursor'] = cursor
+    response = await client.get(
+        "/images/", params=params, headers=token_r.headers
+    )
+    assert response.status_code == StC.OK
+    assert [image['id'] for image in response.json()] == sorted(ids)[2:]
+    assert 'X-Next-Cursor' not in response.headers
+
+    # -> Get a projection of the images
+
+    params = {'ids': ids, 'fields': ['title']}
+    response = await client.get(
+        "/images/", params=params, headers=token_r.headers
+    )
+    assert response.status_code == StC.OK
+    for image in response.json():
+        assert set(image) == {'id', 'title'}
+
+    params = {'ids': ids, 'fields': ['unknown']}
+    response = await client.get(
+        "/images/", params=params, headers=token_r.headers
+    )
+    assert response.status_code == StC.UNPROCESSABLE_ENTITY
+
+    # -> Filter the images
+
+    params = {'ids': ids, 'patient_nin': 'no-patient'}
+    response = await client.get(
+        "/images/", params=params, headers=token_r.headers
+    )
+    assert response.status_code == StC.OK
+    assert response.json() == []
+
+    # -> Remove images
+
+    response = await delete_images(client, token_r, ids=ids)
+    assert response.status_code == StC.OK
@@ -1,10 +1,21 @@
+import asyncio
 import imghdr
+import os
+import uuid
 from pathlib import Path
 
+import httpx
 import pytest
+from fastapi import HTTPException
 from httpx import AsyncClient, Response
 from http import HTTPStatus as StC
 
+from app.analysis import runner
+from app.analysis.clients import _clients, close_client
+from app.analysis.health import get_health
+from app.config import DATA_FOLDER, IMAGES_FOLDER, MEASUREMENTS_FOLDER
+from app.globals import CIRCUIT_COOLDOWN, CIRCUIT_FAILURES
+from app.data.io_files import delete_file
 from tests.models_test import AccessToken, TokenResponse
 from tests.utils import upload_single_image, delete_images
 
@@ -271,6 +282,14 @@ async def test_service_image(client: AsyncClient, token_r: TokenResponse):
     assert response.status_code == StC.OK
     assert response.json()['image'] == 'OK'
 
+    # The stored measurement was served from the cache
+    response = await client.get("/metrics")
+    assert response.status_code == StC.OK
+    assert (
+        'ariavt_measurement_cache_lookups_total{outcome="hit"}'
+        in response.text
+    )
+
     # Remove image previously uploaded
     response = await delete_images(client, token_r, ids=[image_id])
     assert response.status_code == StC.OK
@@ -283,3 +302,459 @@ async def test_service_image(client: AsyncClient, token_r: TokenResponse):
         headers=token_r.headers,
     )
     assert response.status_code == StC.NOT_FOUND
+
+
+@pytest.mark.asyncio
+async def test_service_job(client: AsyncClient, token_r: TokenResponse):
+
+    # -> Upload single image
+    image_name = 'c_im0236.png'
+    response = await upload_single_image(client, token_r, image_name)
+    assert response.status_code == StC.OK
+    image_id = response.json()['id']
+
+    # -> Add service: measurement result
+    service = {
+        "name": "service_job",
+        "url": "http://127.0.0.1:8888/json",
+        "result_type": "measurement",
+        "full_name": "Service job",
+        "description": "Service for queued image analysis",
+    }
+    response = await client.post(
+        "/services/",
+        data=service,
+        headers=token_r.headers
+    )
+    assert response.status_code == StC.OK
+    service_id = response.json()['id']
+
+    # -> Submit the analysis and poll the job until it finishes
+    response = await client.post(
+        f"/services/{service_id}/jobs",
+        params={'image_id': image_id},
+        headers=token_r.headers,
+    )
+    assert response.status_code == StC.ACCEPTED
+    job_id = response.json()['job_id']
+
+    for _ in range(50):
+        response = await client.get(
+            f"/services/jobs/{job_id}", headers=token_r.headers
+        )
+        assert response.status_code == StC.OK
+        if response.json()['status'] in ('done', 'failed'):
+            break
+        await asyncio.sleep(0.2)
+    assert response.json()['status'] == 'done'
+    assert response.json()['result_id']
+
+    # -> Get the stored result
+    response = await client.get(
+        f"/services/{service_id}",
+        params={'image_id': image_id, 'get_only_finished': True},
+        headers=token_r.headers,
+    )
+    assert response.status_code == StC.OK
+    assert response.json()['image'] == 'OK'
+
+    # -> Submitting it again completes right away
+    response = await client.post(
+        f"/services/{service_id}/jobs",
+        params={'image_id': image_id},
+        headers=token_r.headers,
+    )
+    job_id = response.json()['job_id']
+    response = await client.get(
+        f"/services/jobs/{job_id}", headers=token_r.headers
+    )
+    assert response.json()['status'] == 'done'
+
+    # Remove image previously uploaded
+    response = await delete_images(client, token_r, ids=[image_id])
+    assert response.status_code == StC.OK
+
+
+@pytest.mark.asyncio
+async def test_service_batch(client: AsyncClient, token_r: TokenResponse):
+
+    # -> Upload images
+    image_ids = []
+    for image_name in ['c_im0236.png', 'c_im0237.png']:
+        response = await upload_single_image(client, token_r, image_name)
+        assert response.status_code == StC.OK
+        image_ids.append(response.json()['id'])
+
+    # -> Add service: measurement result
+    service = {
+        "name": "service_batch",
+        "url": "http://127.0.0.1:8888/json",
+        "result_type": "measurement",
+        "full_name": "Service batch",
+        "description": "Service for batch image analysis",
+    }
+    response = await client.post(
+        "/services/",
+        data=service,
+        headers=token_r.headers
+    )
+    assert response.status_code == StC.OK
+    service_id = response.json()['id']
+
+    # -> Analyse the images of a selection
+    response = await client.post(
+        '/images/selection',
+        json=image_ids,
+        headers=token_r.headers
+    )
+    selection = response.json()['selection']
+
+    batch = {'selection': selection, 'service_ids': [service_id]}
+    response = await client.post(
+        "/services/batch", json=batch, headers=token_r.headers
+    )
+    assert response.status_code == StC.OK
+    outcomes = response.json()
+    assert sorted(outcome['image_id'] for outcome in outcomes) == image_ids
+    assert all(outcome['status'] == 'done' for outcome in outcomes)
+
+    # -> Already analysed images are skipped, unless forced
+    batch = {'image_ids': image_ids, 'service_ids': [service_id]}
+    response = await client.post(
+        "/services/batch", json=batch, headers=token_r.headers
+    )
+    assert all(outcome['status'] == 'skipped' for outcome in response.json())
+
+    batch['force_analysis'] = True
+    response = await client.post(
+        "/services/batch", json=batch, headers=token_r.headers
+    )
+    assert all(outcome['status'] == 'done' for outcome in response.json())
+
+    # Remove images previously uploaded
+    response = await delete_images(client, token_r, ids=image_ids)
+    assert response.status_code == StC.OK
+
+
+@pytest.mark.asyncio
+async def test_service_health(client: AsyncClient, token_r: TokenResponse):
+
+    # -> Add service
+    service = {
+        "name": "service_health",
+        "url": "http://127.0.0.1:8888/json",
+        "health_url": "http://127.0.0.1:8888/ping",
+        "result_type": "measurement",
+        "full_name": "Service health",
+        "description": "Service with a health URL",
+    }
+    response = await client.post(
+        "/services/",
+        data=service,
+        headers=token_r.headers
+    )
+    assert response.status_code == StC.OK
+    service_id = response.json()['id']
+
+    # -> Get the health of the services
+    response = await client.get(
+        "/services/health", headers=token_r.headers
+    )
+    assert response.status_code == StC.OK
+    assert service_id in [health['service_id'] for health in response.json()]
+
+    response = await client.get(
+        f"/services/{service_id}/health", headers=token_r.headers
+    )
+    assert response.status_code == StC.OK
+    assert response.json()['state'] == 'closed'
+
+    response = await client.get(
+        "/services/0/health", headers=token_r.headers
+    )
+    assert response.status_code == StC.NOT_FOUND
+
+    # -> Remove the service
+    response = await client.delete(
+        f"/services/{service_id}", headers=token_r.headers
+    )
+    assert response.status_code == StC.OK
+
+
+@pytest.mark.asyncio
+async def test_service_endpoints(client: AsyncClient, token_r: TokenResponse):
+
+    # -> Add service
+    service = {
+        "name": "service_replicas",
+        "url": "http://127.0.0.1:8888/json",
+        "result_type": "measurement",
+        "full_name": "Service with replicas",
+        "description": "Service with several endpoints",
+        "deadline": 30,
+        "max_retries": 2,
+        "hedge": True,
+    }
+    response = await client.post(
+        "/services/",
+        data=service,
+        headers=token_r.headers
+    )
+    assert response.status_code == StC.OK
+    service_id = response.json()['id']
+
+    response = await client.get(
+        f"/services/{service_id}", headers=token_r.headers
+    )
+    assert response.status_code == StC.OK
+    assert response.json()['deadline'] == 30
+    assert response.json()['max_retries'] == 2
+    assert response.json()['hedge'] is True
+
+    # -> A deadline of 0 clears it
+    response = await client.put(
+        f"/services/{service_id}",
+        data={"deadline": 0},
+        headers=token_r.headers
+    )
+    assert response.status_code == StC.OK
+    response = await client.get(
+        f"/services/{service_id}", headers=token_r.headers
+    )
+    assert response.json()['deadline'] is None
+
+    # -> Add a replica
+    replica = {"url": "http://127.0.0.1:8889/json"}
+    response = await client.post(
+        f"/services/{service_id}/endpoints",
+        data=replica,
+        headers=token_r.headers
+    )
+    assert response.status_code == StC.CREATED
+    endpoint_id = response.json()['id']
+
+    response = await client.post(
+        f"/services/{service_id}/endpoints",
+        data=replica,
+        headers=token_r.headers
+    )
+    assert response.status_code == StC.CONFLICT
+
+    response = await client.get(
+        f"/services/{service_id}/endpoints", headers=token_r.headers
+    )
+    assert response.status_code == StC.OK
+    assert [endpoint['id'] for endpoint in response.json()] == [endpoint_id]
+
+    # -> Both endpoints are reported in the health of the service
+    response = await client.get(
+        f"/services/{service_id}/health", headers=token_r.headers
+    )
+    assert response.status_code == StC.OK
+    assert [
+        endpoint['url'] for endpoint in response.json()['endpoints']
+    ] == [service['url'], replica['url']]
+
+    # -> Remove the replica
+    response = await client.delete(
+        f"/services/{service_id}/endpoints/{endpoint_id}",
+        headers=token_r.headers
+    )
+    assert response.status_code == StC.OK
+
+    response = await client.delete(
+        f"/services/{service_id}/endpoints/{endpoint_id}",
+        headers=token_r.headers
+    )
+    assert response.status_code == StC.NOT_FOUND
+
+    # -> Remove the service
+    response = await client.delete(
+        f"/services/{service_id}", headers=token_r.headers
+    )
+    assert response.status_code == StC.OK
+
+
+# =====================================================================
+# Request policy of the services, against stub transports
+
+
+@pytest.fixture
+def stub_image():
+    relative_path = os.path.join(
+        IMAGES_FOLDER, 'stub-{}.png'.format(uuid.uuid4().hex)
+    )
+    with open(os.path.join(DATA_FOLDER, relative_path), 'wb') as f:
+        f.write(b'\x89PNG\r\n\x1a\n' + bytes(1024))
+    yield relative_path
+    os.remove(os.path.join(DATA_FOLDER, relative_path))
+
+
+def stub_service(service_id: int, handler, **policy) -> dict:
+    """Service whose requests are answered by `handler`."""
+    _clients[service_id] = AsyncClient(transport=httpx.MockTransport(handler))
+    db_service = dict(
+        id=service_id,
+        name='stub_{}'.format(service_id),
+        url='http://stub-{}.test/analyse'.format(service_id),
+        health_url=None,
+        deadline=None,
+        max_retries=0,
+        hedge=False,
+    )
+    db_service.update(policy)
+    return db_service
+
+
+@pytest.mark.asyncio
+async def test_service_policy_retry(client: AsyncClient, stub_image: str):
+    calls = []
+
+    def handler(request):
+        calls.append(request.url)
+        if len(calls) == 1:
+            return Response(500)
+        return Response(200, json={'ok': True})
+
+    db_service = stub_service(1000001, handler, max_retries=1)
+    retries = runner.analysis_retries.get(service=db_service['name'])
+    try:
+        temp_path, _ = await runner._post_with_policy(
+            db_service, stub_image, MEASUREMENTS_FOLDER
+        )
+        await delete_file(temp_path)
+    finally:
+        await close_client(db_service['id'])
+    assert len(calls) == 2
+    assert runner.analysis_retries.get(
+        service=db_service['name']
+    ) == retries + 1
+
+    # -> Without retries, the failure is returned
+    calls.clear()
+    db_service = stub_service(1000002, handler)
+    try:
+        with pytest.raises(HTTPException) as e:
+            await runner._post_with_policy(
+                db_service, stub_image, MEASUREMENTS_FOLDER
+            )
+    finally:
+        await close_client(db_service['id'])
+    assert e.value.status_code == StC.BAD_GATEWAY
+    assert len(calls) == 1
+
+
+@pytest.mark.asyncio
+async def test_service_policy_hedge(
+        client: AsyncClient, stub_image: str, monkeypatch):
+    slow = 'http://slow.test/analyse'
+    fast = 'http://fast.test/analyse'
+    cancelled = asyncio.Event()
+
+    async def handler(request):
+        if request.url.host == 'slow.test':
+            try:
+                await asyncio.sleep(5)
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+        return Response(200, json={'host': request.url.host})
+
+    db_service = stub_service(1000003, handler, hedge=True)
+    monkeypatch.setattr(runner, 'get_endpoints', lambda db_services: {
+        db_services[0]['id']: [
+            dict(url=slow, health_url=None), dict(url=fast, health_url=None)
+        ]
+    })
+    # The slow endpoint usually answers first, in 50 ms
+    for _ in range(20):
+        get_health(slow).record(True, 0.05)
+        get_health(fast).record(True, 1)
+
+    hedges = runner.analysis_hedges.get(
+        service=db_service['name'], winner='hedge'
+    )
+    try:
+        temp_path, head = await runner._post_with_policy(
+            db_service, stub_image, MEASUREMENTS_FOLDER
+        )
+        await delete_file(temp_path)
+    finally:
+        await close_client(db_service['id'])
+    assert b'fast.test' in head
+    assert runner.analysis_hedges.get(
+        service=db_service['name'], winner='hedge'
+    ) == hedges + 1
+    # The losing request was cancelled and is no longer in progress
+    assert cancelled.is_set()
+    assert get_health(slow).outstanding == 0
+    assert runner.analysis_requests.get(
+        service=db_service['name'], outcome='cancelled'
+    ) == 1
+
+
+@pytest.mark.asyncio
+async def test_service_policy_deadline(client: AsyncClient, stub_image: str):
+
+    async def handler(request):
+        await asyncio.sleep(5)
+        return Response(200, json={})
+
+    db_service = stub_service(1000004, handler, deadline=0.2)
+    try:
+        with pytest.raises(HTTPException) as e:
+            await asyncio.wait_for(
+                runner._post_with_policy(
+                    db_service, stub_image, MEASUREMENTS_FOLDER
+                ),
+                timeout=2
+            )
+    finally:
+        await close_client(db_service['id'])
+    assert e.value.status_code == StC.GATEWAY_TIMEOUT
+    assert runner.analyses.get(
+        service=db_service['name'], outcome='deadline_exceeded'
+    ) == 1
+
+
+@pytest.mark.asyncio
+async def test_service_circuit_trial(client: AsyncClient, stub_image: str):
+
+    async def handler(request):
+        await asyncio.sleep(5)
+        return Response(200, json={})
+
+    db_service = stub_service(1000005, handler, deadline=0.2)
+    health = get_health(db_service['url'])
+    # Open the circuit, and let its cooldown pass
+    for _ in range(CIRCUIT_FAILURES):
+        health.record(False, 1)
+    health._opened_at -= CIRCUIT_COOLDOWN
+    assert health.accepts_trial()
+
+    # -> The trial request is released when the deadline cancels it
+    try:
+        with pytest.raises(HTTPException) as e:
+            await runner._post_with_policy(
+                db_service, stub_image, MEASUREMENTS_FOLDER
+            )
+    finally:
+        await close_client(db_service['id'])
+    assert e.value.status_code == StC.GATEWAY_TIMEOUT
+    assert health.accepts_trial()
+
+    # -> A missing image does not take the trial request either
+    with pytest.raises(HTTPException) as e:
+        await runner._post_image(
+            db_service, db_service['url'], 'missing.png', MEASUREMENTS_FOLDER
+        )
+    assert e.value.status_code == StC.NOT_FOUND
+    assert health.accepts_trial()
+
+    # -> A health probe does not release a trial request in progress
+    assert health.allow_request()
+    health.record(False)
+    health._opened_at -= CIRCUIT_COOLDOWN
+    assert not health.accepts_trial()
+    health.release_trial()
+    assert health.accepts_trial()
@@ -183,6 +183,43 @@ async def test_user_methods(client: AsyncClient, token_r: TokenResponse):
 
     # -----------------------------------------------------------------
 
+    # -> An administrator cannot disable themselves
+
+    response = await client.get("/users/me", headers=token_r.headers)
+    assert response.status_code == StC.OK
+    admin_id = response.json()['id']
+    admin_disabled = dict(
+        full_name='admin', email='admin@ariavt.org', role='admin',
+        disabled=True
+    )
+    response = await client.put(
+        "/users/{}".format(admin_id),
+        data=admin_disabled,
+        headers=token_r.headers
+    )
+    assert response.status_code == StC.BAD_REQUEST
+
+    # -> A disabled user cannot refresh its access token
+
+    refresh_token = user_tr.tokens['refresh_token']
+    user1_disabled = user1.copy()
+    del user1_disabled['username']
+    del user1_disabled['password']
+    user1_disabled['disabled'] = True
+    response = await client.put(
+        "/users/{}".format(user1_id),
+        data=user1_disabled,
+        headers=token_r.headers
+    )
+    assert response.status_code == StC.OK
+
+    response = await client.post(
+        "/token/refresh", data={"refresh_token": refresh_token}
+    )
+    assert response.status_code == StC.UNAUTHORIZED
+
+    # -----------------------------------------------------------------
+
     # -> Delete added users
 
     response = await client.delete(